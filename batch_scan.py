@@ -0,0 +1,261 @@
+from __future__ import absolute_import  # fix known bug of PyCharm
+import argparse
+import csv
+import json
+import os
+import signal
+import sys
+import cv2
+from multiprocessing import Pool, cpu_count
+from Queue import Queue, Empty
+from time import time
+from src.raw_photo import RawPhoto
+from src.paper_scan import MAX_NUM_QUESTIONS
+from src.export import CsvExport, ParquetExport, export_columns
+
+##
+# Scans a directory or a manifest of photos in a pool of worker processes and writes one JSON line per photo, and
+# optionally one CSV or Parquet row per paper.
+# Usage: python batch_scan.py SOURCE OUTPUT --num-papers m [--num-questions n] [--workers k] [--export PATH]
+##
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+PREFETCH_PER_WORKER = 2
+WAIT_INTERVAL = 1           # seconds between checks that the worker processes are alive while waiting for a photo
+
+
+def list_inputs(source):
+    """
+    Lists the photos to scan.
+    :param source: a directory of photos, or a manifest file listing one photo path per line (relative paths are
+                   relative to the manifest)
+    :return: list of photo paths
+    """
+    if os.path.isdir(source):
+        return sorted(os.path.join(source, name) for name in os.listdir(source)
+                      if name.lower().endswith(IMAGE_EXTENSIONS))
+    base = os.path.dirname(source)
+    with open(source) as f:
+        return [os.path.join(base, line.strip()) for line in f if line.strip() and not line.startswith('#')]
+
+
+def done_inputs(output_path, retry_errors=False):
+    """
+    Reads which photos an earlier run already wrote to the output file.
+    A line cut off by a crash is ignored, so that its photo is scanned again.
+    :param output_path: path of the JSON lines output file
+    :param retry_errors: whether photos that failed in an earlier run should be scanned again
+    :return: set of photo paths
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if not (retry_errors and 'error' in record):
+                done.add(record['path'])
+    return done
+
+
+def scan_file(job):
+    """
+    Decodes and scans one photo. Runs in a worker process; any failure is reported in the record instead of raised.
+    Only the results of the papers are sent back, and serialized by the writer.
+    :param job: (photo path, number of papers, number of questions) as a tuple
+    :return: record of the photo, with either `papers` and `metadata` entries or an `error` entry
+    """
+    path, num_papers, num_questions = job
+    try:
+        raw_img = cv2.imread(path, 0)
+        if raw_img is None:
+            raise IOError('could not decode image')
+        rp = RawPhoto(raw_img, num_papers, num_questions)
+        return {'path': path, 'papers': rp.results, 'metadata': rp.metadata}
+    except Exception as e:
+        return {'path': path, 'error': '%s: %s' % (type(e).__name__, e)}
+
+
+def json_line(record):
+    """
+    Serializes the record of a photo, as returned by scan_file().
+    :return: JSON line of the photo, with its `path` and either its `result`, as RawPhoto.dump_data(), or an `error`
+    """
+    if 'error' in record:
+        return json.dumps(record) + '\n'
+    result = {'papers': [paper.to_dict() for paper in record['papers']], 'metadata': record['metadata']}
+    return json.dumps({'path': record['path'], 'result': result}) + '\n'
+
+
+def open_export(export_path, num_questions):
+    """
+    Opens the bulk export of a run, in the format given by the extension of its path.
+    A CSV export is appended to, like the JSON lines output, and photos it already holds are not written again, as
+    when a run stopped between exporting a photo and writing its line. A Parquet export is a directory to which each
+    run adds a part file, likewise without the photos earlier parts hold.
+    :param export_path: path of a .csv file, or of a .parquet directory
+    :param num_questions: number of questions in each paper
+    :return: CsvExport or ParquetExport object
+    """
+    if export_path.lower().endswith('.parquet'):
+        if os.path.isfile(export_path):
+            raise ValueError('Parquet export must be a directory of part files, not a file: %s' % export_path)
+        return ParquetExport(export_path, num_questions)
+    if not export_path.lower().endswith('.csv'):
+        raise ValueError('export must be a .csv or .parquet file: %s' % export_path)
+    out = open_appending(export_path)
+    return CsvExport(out, num_questions, header=not out.tell(), exported=exported_paths(out, num_questions))
+
+
+def exported_paths(f, num_questions):
+    """
+    Reads which photos an earlier run already wrote to a CSV export. A row cut off by a crash is ignored.
+    :param f: file object of the export, opened for reading
+    :param num_questions: number of questions in each paper
+    :return: set of photo paths
+    """
+    end = f.tell()
+    f.seek(0)
+    columns = len(export_columns(num_questions))
+    paths = set(row[0] for row in csv.reader(f) if len(row) == columns)
+    paths.discard('path')
+    f.seek(end)
+    return paths
+
+
+def open_appending(path):
+    """
+    Opens a file to append lines to, starting on a fresh line if the last run was cut off in the middle of one.
+    :param path: path of the file
+    :return: file object
+    """
+    out = open(path, 'a+')
+    out.seek(0, os.SEEK_END)
+    if out.tell():
+        out.seek(-1, os.SEEK_END)
+        if out.read(1) != '\n':
+            out.write('\n')
+    return out
+
+
+def worker_pids(pool):
+    """
+    Lists the worker processes of a pool. multiprocessing has no public way to, so this reads the private list of
+    processes of Pool as Python 2.7 keeps it, `_pool`; it is the only place that depends on it.
+    :param pool: Pool object
+    :return: set of the process ids of the workers
+    """
+    return set(worker.pid for worker in pool._pool)
+
+
+def next_record(pool, finished, pids):
+    """
+    Waits for the next photo to finish. Waits in short steps, so that a keyboard interrupt is not held up, and checks
+    in between that no worker process died, as the photo it was scanning would never finish.
+    :param pool: Pool object scanning the photos
+    :param finished: Queue object the records of the photos are put in as they finish
+    :param pids: set of the process ids of the workers of the pool when it started
+    :return: record of the photo, as returned by scan_file()
+    """
+    while True:
+        try:
+            return finished.get(timeout=WAIT_INTERVAL)
+        except Empty:
+            # the pool replaces dead workers, so a death shows as a process id it did not start with
+            if worker_pids(pool) != pids:
+                raise RuntimeError('a worker process died; run again to resume after the photos written so far')
+
+
+def ignore_interrupt():
+    """
+    Leaves keyboard interrupts to the parent process.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run(inputs, output_path, num_papers, num_questions=MAX_NUM_QUESTIONS, workers=None,
+        prefetch=PREFETCH_PER_WORKER, retry_errors=False, export_path=None):
+    """
+    Scans photos in a pool of worker processes and appends a JSON line to the output file as each photo finishes.
+    Photos already in the output file are skipped, so that an interrupted run can be resumed. At most `prefetch` photos
+    per worker are decoded ahead of the writer.
+    The papers found are also written to the export file, if any, before the line of their photo, so that a photo
+    interrupted in between is exported again rather than missing. A worker process dying, e.g. killed for lack of
+    memory, stops the run with a RuntimeError instead of leaving it waiting for the photo it was scanning.
+    :param inputs: list of photo paths
+    :param output_path: path of the JSON lines output file
+    :param num_papers: number of papers in each photo
+    :param num_questions: number of questions in each paper
+    :param workers: number of worker processes, defaults to the number of CPUs
+    :param prefetch: number of photos queued per worker
+    :param retry_errors: whether photos that failed in an earlier run should be scanned again
+    :param export_path: path of a .csv file or .parquet directory to also write one row per paper to, as open_export()
+    :return: (number of photos scanned, number of failures) as a tuple
+    """
+    done = done_inputs(output_path, retry_errors)
+    jobs = [(path, num_papers, num_questions) for path in inputs if path not in done]
+    workers = workers or cpu_count()
+    window = max(1, workers * prefetch)
+    finished = Queue()
+    scanned, failed = 0, 0
+    start = time()
+
+    out = open_appending(output_path)
+    export = open_export(export_path, num_questions) if export_path else None
+
+    def write(record):
+        if export is not None and 'error' not in record:
+            export.write(record['path'], record['papers'])
+        out.write(json_line(record))
+        out.flush()
+        sys.stderr.write('\r[%d/%d] %.1f photos/s  %s' % (scanned + 1, len(jobs), (scanned + 1) / (time() - start),
+                                                          record['path']))
+
+    pool = Pool(workers, ignore_interrupt)
+    pids = worker_pids(pool)
+    try:
+        outstanding = 0
+        for job in jobs:
+            if outstanding >= window:
+                record = next_record(pool, finished, pids)
+                write(record)
+                scanned, failed, outstanding = scanned + 1, failed + ('error' in record), outstanding - 1
+            pool.apply_async(scan_file, (job,), callback=finished.put)
+            outstanding += 1
+        while outstanding:
+            record = next_record(pool, finished, pids)
+            write(record)
+            scanned, failed, outstanding = scanned + 1, failed + ('error' in record), outstanding - 1
+        pool.close()
+    except (KeyboardInterrupt, RuntimeError):
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        out.close()
+        if export is not None:
+            export.close()
+        if jobs:
+            sys.stderr.write('\n')
+    return scanned, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scan a batch of photos of bubble sheets.')
+    parser.add_argument('source', help='directory of photos, or manifest file with one photo path per line')
+    parser.add_argument('output', help='JSON lines file the results are appended to')
+    parser.add_argument('--num-papers', type=int, required=True, help='number of papers in each photo')
+    parser.add_argument('--num-questions', type=int, default=MAX_NUM_QUESTIONS, help='number of questions')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: CPUs)')
+    parser.add_argument('--prefetch', type=int, default=PREFETCH_PER_WORKER, help='photos queued per worker')
+    parser.add_argument('--retry-errors', action='store_true', help='scan photos that failed before again')
+    parser.add_argument('--export', default=None,
+                        help='.csv file to also append one row per paper to, or .parquet directory to add them to')
+    args = parser.parse_args()
+
+    num_scanned, num_failed = run(list_inputs(args.source), args.output, args.num_papers, args.num_questions,
+                                  args.workers, args.prefetch, args.retry_errors, args.export)
+    sys.stderr.write('%d photo(s) scanned, %d failed\n' % (num_scanned, num_failed))
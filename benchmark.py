@@ -0,0 +1,532 @@
+from __future__ import absolute_import  # fix known bug of PyCharm
+import argparse
+import gc
+import json
+import os
+import resource
+import sys
+import cv2
+import numpy as np
+from glob import glob
+from multiprocessing import Pool
+from timeit import default_timer
+from load_test import percentile
+from src import raw_photo
+from src.raw_photo import RawPhoto, find_quads
+from src.layout import load_layout
+from src.scan_result import ScanResult
+from src.grading import grade_exam, UNKNOWN_TEST_ID
+from src.paper_scan import max_and_min, decode_datamatrix, GAP_THRESHOLD, TRIM_ROWS_TO_SCAN, TRIM_THRESHOLD, \
+    MAX_NUM_QUESTIONS
+
+##
+# Times the scanning pipeline and each of its stages on the test images and on upscaled and rotated variants of them,
+# and compares the timings against a baseline file. With --readers, compares the answer readers of PaperScan against
+# the original per-pixel loops instead. With --grading, grades a synthetic exam both with the grading module and sheet
+# by sheet.
+# Usage: python benchmark.py [image ...] [--save-baseline FILE] [--baseline FILE [--threshold t]] [--readers]
+#        python benchmark.py --grading [SHEETS]
+##
+
+DEFAULT_IMAGES = sorted(glob('tst/*')) + ['bubble_sheet/sample.jpeg']
+NUM_PAPERS = 2
+REPEAT = 10                 # least timed runs of each stage on each photo, after one untimed warm-up run
+MIN_STAGE_SECONDS = 1.0     # least time the timed runs of a stage on a photo are spread over
+
+# Variants of the test images
+VARIANTS = ['original', 'upscaled', 'rotated90', 'rotated180', 'tilted']
+UPSCALE_FACTOR = 2
+TILT_DEGREES = 4
+
+# Regression gate
+REGRESSION_THRESHOLD = 0.2       # allowed slowdown (or growth of peak memory) relative to the baseline
+MIN_LATENCY_REGRESSION_MS = 2.0  # smaller slowdowns of a stage are noise
+MIN_MEMORY_REGRESSION_MB = 1.0   # smaller growths of peak memory are noise
+CONFIRM_ROUNDS = 2               # times a stage that seems to regress is measured again before the gate fails
+
+# Synthetic exam
+GRADING_SHEETS = 50000
+GRADING_TESTS = 4               # versions of the exam, each with its own answer key
+UNREAD_TEST_ID_RATE = 0.01      # share of sheets whose datamatrix could not be read
+BLANK_RATE = 0.05
+MULTIPLE_RATE = 0.02
+
+# Geometry of the default sheet format
+LAYOUT = load_layout()
+NUM_OPTIONS = LAYOUT.num_options
+LEFT_RIGHT_MARGIN = LAYOUT.option_margin
+VERTICAL_SCAN_RANGE = list(LAYOUT.vertical_scan_range)
+IDX_TO_LETTER = LAYOUT.option_labels
+
+
+def loop_trim_offsets(ans_img_thr):
+    """
+    Finds the number of rows and columns to trim off each side of an answer block one line at a time, the way
+    remove_edges originally did.
+    :param ans_img_thr: binary image of the answer block
+    :return: (top, bottom, left, right) offsets as a tuple
+    """
+    h, w = ans_img_thr.shape[:2]
+
+    # Top
+    t = 0
+    flag = False
+    for t in range(TRIM_ROWS_TO_SCAN):
+        if sum(ans_img_thr[t]) > TRIM_THRESHOLD * w * 255:
+            flag = True
+        else:
+            if flag:
+                break
+    if t == TRIM_ROWS_TO_SCAN - 1:
+        t = 0
+
+    # Bottom
+    b = 0
+    flag = False
+    for b in range(TRIM_ROWS_TO_SCAN):
+        if sum(ans_img_thr[- (b + 1)]) > TRIM_THRESHOLD * w * 255:
+            flag = True
+        else:
+            if flag:
+                break
+    if b == TRIM_ROWS_TO_SCAN - 1:
+        b = 0
+
+    # Left
+    l = 0
+    flag = False
+    for l in range(TRIM_ROWS_TO_SCAN):
+        if sum(ans_img_thr[:, l]) > TRIM_THRESHOLD * h * 255:
+            flag = True
+        else:
+            if flag:
+                break
+    if l == TRIM_ROWS_TO_SCAN - 1:
+        l = 0
+
+    # Right
+    r = 0
+    flag = False
+    for r in range(TRIM_ROWS_TO_SCAN):
+        if sum(ans_img_thr[:, - (r + 1)]) > TRIM_THRESHOLD * h * 255:
+            flag = True
+        else:
+            if flag:
+                break
+    if r == TRIM_ROWS_TO_SCAN - 1:
+        r = 0
+
+    return t, b, l, r
+
+
+def loop_brightness(paper, i):
+    """
+    Sums the brightness of each option of an answer block pixel by pixel, the way the readers originally did.
+    :param paper: PaperScan object
+    :param i: index of the answer block
+    :return: (brightness, num_pts) as lists, one entry per option
+    """
+    raw_img = paper.ans_imgs_raw[i]
+    h, w = raw_img.shape[:2]
+    t, b, l, r = loop_trim_offsets(paper.ans_imgs_thr[i])
+    img = raw_img[t:h - b, l:w - r]
+    img_height, img_width = img.shape[:2]
+    block_width = int((img_width - 2 * LEFT_RIGHT_MARGIN) / NUM_OPTIONS)
+    boundary_pts = [LEFT_RIGHT_MARGIN] + [0] * NUM_OPTIONS
+    for j in range(NUM_OPTIONS):
+        boundary_pts[j + 1] = boundary_pts[0] + (j + 1) * block_width
+
+    brightness = [0] * NUM_OPTIONS
+    num_pts = [0] * NUM_OPTIONS
+    for j in range(NUM_OPTIONS):
+        for x in range(VERTICAL_SCAN_RANGE[0], VERTICAL_SCAN_RANGE[1]):
+            for y in range(boundary_pts[j], boundary_pts[j + 1]):
+                brightness[j] += img[x, y]
+        num_pts[j] = (VERTICAL_SCAN_RANGE[1] - VERTICAL_SCAN_RANGE[0]) * (boundary_pts[j + 1] - boundary_pts[j])
+    return brightness, num_pts
+
+
+def loop_read_single(paper):
+    """
+    Reference single-answer reader.
+    :param paper: PaperScan object
+    :return: list of marked answers
+    """
+    answers = []
+    for i in range(paper.num_questions):
+        brightness, _ = loop_brightness(paper, i)
+        answers.append(IDX_TO_LETTER[brightness.index(min(brightness))])
+    return answers
+
+
+def loop_read_multiple(paper):
+    """
+    Reference multi-answer reader.
+    :param paper: PaperScan object
+    :return: list of marked answers
+    """
+    answers = []
+    for i in range(paper.num_questions):
+        max_ref, min_ref = max_and_min(paper.ans_imgs_raw[i])
+        brightness, num_pts = loop_brightness(paper, i)
+        threshold = min_ref + (max_ref - min_ref) * GAP_THRESHOLD
+        answers.append(''.join(IDX_TO_LETTER[j] for j in range(NUM_OPTIONS)
+                               if brightness[j] / num_pts[j] < threshold))
+    return answers
+
+
+def best_time(func, repeat=REPEAT):
+    """
+    Times a function.
+    :param func: function without arguments
+    :return: (best time in seconds, return value of the last call)
+    """
+    best, res = None, None
+    for _ in range(repeat):
+        start = default_timer()
+        res = func()
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, res
+
+
+def bench_readers(image_paths):
+    """
+    Times the loop readers against the vectorized readers on every paper and checks that they agree.
+    :param image_paths: list of image paths
+    :return: True if all papers were read the same way by both readers
+    """
+    agree = True
+    totals = [0.0, 0.0, 0.0, 0.0]
+    print('%-28s %5s %10s %10s %10s %10s' % ('image', 'paper', 'loop-1', 'vec-1', 'loop-n', 'vec-n'))
+    for path in image_paths:
+        rp = RawPhoto(cv2.imread(path, 0), NUM_PAPERS, keep_images=True)
+        for k, paper in enumerate(rp.paper_objs):
+            t_loop_single, loop_single = best_time(lambda: loop_read_single(paper))
+            t_vec_single, _ = best_time(paper.read_all_answers_single)
+            vec_single = list(paper.marked_ans[:paper.num_questions])
+            t_loop_multiple, loop_multiple = best_time(lambda: loop_read_multiple(paper))
+            t_vec_multiple, _ = best_time(paper.raad_all_answers_multiple)
+            vec_multiple = list(paper.marked_ans[:paper.num_questions])
+            if loop_single != vec_single or loop_multiple != vec_multiple:
+                agree = False
+                print('  ! answers differ on %s paper %d' % (path, k))
+            timings = [t_loop_single, t_vec_single, t_loop_multiple, t_vec_multiple]
+            totals = [a + b for a, b in zip(totals, timings)]
+            print('%-28s %5d %9.2fms %9.2fms %9.2fms %9.2fms' % ((path, k) + tuple(t * 1000 for t in timings)))
+    if totals[1] and totals[3]:
+        print('speedup: single %.1fx, multiple %.1fx' % (totals[0] / totals[1], totals[2] / totals[3]))
+    return agree
+
+
+def make_exam(num_sheets, num_questions=MAX_NUM_QUESTIONS, seed=0):
+    """
+    Makes up the results of an exam: sheets of students of varying ability, with blanks, multiple marks and unread
+    test ids.
+    :param num_sheets: number of sheets
+    :param num_questions: number of questions
+    :param seed: seed of the random generator
+    :return: (list of ScanResult objects, dictionary of the answer key of each test id) as a tuple
+    """
+    rng = np.random.RandomState(seed)
+    test_ids = ['%05d' % (i + 1) for i in range(GRADING_TESTS)]
+    keys = dict((test_id, rng.randint(NUM_OPTIONS, size=num_questions)) for test_id in test_ids)
+    sheet_tests = rng.randint(GRADING_TESTS, size=num_sheets)
+    ability = rng.uniform(0.3, 0.95, size=(num_sheets, 1))
+    ease = rng.uniform(0.6, 1.4, size=(1, num_questions))
+    choices = np.array([keys[test_ids[t]] for t in sheet_tests])
+    wrong = rng.uniform(size=choices.shape) > ability * ease
+    choices[wrong] = (choices[wrong] + rng.randint(1, NUM_OPTIONS, size=wrong.sum())) % NUM_OPTIONS
+    answers = (1 << choices).astype(np.uint8)
+    answers[rng.uniform(size=answers.shape) < MULTIPLE_RATE] |= 1
+    answers[rng.uniform(size=answers.shape) < BLANK_RATE] = 0
+    unread = rng.uniform(size=num_sheets) < UNREAD_TEST_ID_RATE
+    sheets = [ScanResult(UNKNOWN_TEST_ID if unread[i] else test_ids[sheet_tests[i]], '%03d' % (i % 1000), answers[i],
+                         num_questions, IDX_TO_LETTER) for i in range(num_sheets)]
+    return sheets, dict((test_id, ''.join(IDX_TO_LETTER[j] for j in key)) for test_id, key in keys.items())
+
+
+def loop_grade(sheets, answer_keys):
+    """
+    Grades sheets one answer at a time, the way it is done downstream of the scanner.
+    :param sheets: list of ScanResult objects
+    :param answer_keys: dictionary of the answer key of each test id, a string of one option label per question
+    :return: list of the score of each sheet, None if it has no answer key
+    """
+    scores = []
+    for sheet in sheets:
+        key = answer_keys.get(sheet.test_id)
+        if key is None:
+            scores.append(None)
+            continue
+        marked = sheet.marked_answers()
+        scores.append(sum(1 for i in range(len(key)) if marked[i] == key[i]))
+    return scores
+
+
+def bench_grading(num_sheets=GRADING_SHEETS):
+    """
+    Times grading a synthetic exam with the grading module against grading it sheet by sheet, and checks that the
+    scores agree.
+    :param num_sheets: number of sheets of the exam
+    :return: True if the scores agree
+    """
+    sheets, answer_keys = make_exam(num_sheets)
+    t_loop, loop_scores = best_time(lambda: loop_grade(sheets, answer_keys), 1)
+    t_vec, (reports, ungraded) = best_time(lambda: grade_exam(sheets, answer_keys))
+    scores = [None] * num_sheets
+    for report in reports.values():
+        for i, score in zip(report.papers.tolist(), report.scores.tolist()):
+            scores[i] = score
+    print('%d sheets, %d tests, %d ungraded' % (num_sheets, len(reports), len(ungraded)))
+    print('loop: %.3fs (scores only), grading module: %.3fs (scores and item analysis), speedup %.1fx'
+          % (t_loop, t_vec, t_loop / t_vec))
+    if scores != loop_scores:
+        print('  ! scores differ')
+        return False
+    return True
+
+
+def make_variant(img, variant):
+    """
+    Derives a synthetic test photo from a real one.
+    :param img: grayscale photo
+    :param variant: one of VARIANTS
+    :return: grayscale photo
+    """
+    if variant == 'upscaled':
+        return cv2.resize(img, None, fx=UPSCALE_FACTOR, fy=UPSCALE_FACTOR, interpolation=cv2.INTER_CUBIC)
+    if variant == 'rotated90':
+        return np.ascontiguousarray(np.rot90(img))
+    if variant == 'rotated180':
+        return np.ascontiguousarray(np.rot90(img, 2))
+    if variant == 'tilted':
+        h, w = img.shape[:2]
+        rotation = cv2.getRotationMatrix2D((w / 2.0, h / 2.0), TILT_DEGREES, 1.0)
+        return cv2.warpAffine(img, rotation, (w, h), borderMode=cv2.BORDER_REPLICATE)
+    return img
+
+
+# inputs of every stage, by (path, variant), prepared before the measuring processes are forked
+prepared = {}
+
+
+def prepare(path, variant):
+    """
+    Scans a test photo once to collect the inputs of each stage.
+    :return: dictionary of the inputs
+    """
+    img = make_variant(cv2.imread(path, 0), variant)
+    rp = RawPhoto(img.copy(), NUM_PAPERS, keep_images=True)
+    thr_img = cv2.adaptiveThreshold(img, raw_photo.THR_MAX_VAL, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV,
+                                    raw_photo.THR_BLOCK_SIZE, raw_photo.THR_OFFSET)
+    quads = [approx for _, approx in find_quads(thr_img, k=NUM_PAPERS)]
+    matrices = [cv2.getPerspectiveTransform(np.float32(rp.orientate_vertices(quad)), LAYOUT.template_key_pts)
+                for quad in quads]
+    return {'img': img, 'rp': rp, 'thr': thr_img, 'quads': quads, 'matrices': matrices, 'papers': rp.paper_objs}
+
+
+def stage_threshold(state):
+    cv2.adaptiveThreshold(state['img'], raw_photo.THR_MAX_VAL, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV,
+                          raw_photo.THR_BLOCK_SIZE, raw_photo.THR_OFFSET)
+
+
+def stage_find_contours(state):
+    find_quads(state['thr'], k=max(NUM_PAPERS, 2))
+
+
+def stage_orientate(state):
+    state['rp'].int_img = None
+    for quad in state['quads']:
+        state['rp'].orientate_vertices(quad)
+
+
+def stage_warp(state):
+    for trans_matrix in state['matrices']:
+        cv2.warpPerspective(state['img'], trans_matrix, LAYOUT.paper_size)
+
+
+def stage_paper_threshold(state):
+    for paper in state['papers']:
+        paper.threshold_table()
+
+
+def stage_read_answers(state):
+    for paper in state['papers']:
+        paper.int_img = None
+        paper.read_all_answers_single()
+
+
+def stage_read_datamatrix(state):
+    for paper in state['papers']:
+        decode_datamatrix(paper.raw_img, LAYOUT.datamatrix_region)
+
+
+def stage_pipeline(state):
+    RawPhoto(state['img'], NUM_PAPERS).dump_data()
+
+
+# stages in the order they run, each timed on its own, then the pipeline as a whole
+STAGES = [('threshold', stage_threshold),
+          ('find_contours', stage_find_contours),
+          ('orientate', stage_orientate),
+          ('warp', stage_warp),
+          ('paper_threshold', stage_paper_threshold),
+          ('read_answers', stage_read_answers),
+          ('read_datamatrix', stage_read_datamatrix),
+          ('pipeline', stage_pipeline)]
+
+
+def measure_stage(job):
+    """
+    Runs one stage on one prepared photo. Runs in a fresh worker process, so that the growth of its peak resident size
+    is what the stage allocated. The first run warms up the caches and lazy initializations and is only measured for
+    memory; the runs after it are timed, at least `repeat` of them and for at least MIN_STAGE_SECONDS, so that quick
+    stages are sampled over as long a stretch of the load of the machine as slow ones.
+    :param job: (path, variant, stage index, repeat) as a tuple
+    :return: (list of times in seconds, growth of the peak resident size in MB) as a tuple
+    """
+    path, variant, stage_idx, repeat = job
+    state = prepared[(path, variant)]
+    func = STAGES[stage_idx][1]
+    times = []
+    # the stages print their diagnostics
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        gc.collect()
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        func(state)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+        while len(times) < repeat or sum(times) < MIN_STAGE_SECONDS:
+            start = default_timer()
+            func(state)
+            times.append(default_timer() - start)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return times, peak / 1024.0  # ru_maxrss is in KB on Linux
+
+
+def bench_stages(image_paths, variants=VARIANTS, repeat=REPEAT, names=None):
+    """
+    Times the pipeline and each of its stages on every test photo and variant.
+    :param image_paths: list of image paths
+    :param variants: names of the variants of each photo to run
+    :param repeat: least number of runs of each stage on each photo
+    :param names: names of the stages to time, all if None
+    :return: dictionary of the results by stage name, each with p50 and p95 latency per photo in ms, the median over
+             the photos of their best time in ms, throughput in photos per second and the largest growth of the peak
+             resident size in MB
+    """
+    for path in image_paths:
+        for variant in variants:
+            prepared[(path, variant)] = prepare(path, variant)
+    results = {}
+    for stage_idx, (name, _) in enumerate(STAGES):
+        if names is not None and name not in names:
+            continue
+        times, best, peaks = [], [], []
+        for path in image_paths:
+            for variant in variants:
+                pool = Pool(1)
+                try:
+                    stage_times, peak = pool.apply(measure_stage, ((path, variant, stage_idx, repeat),))
+                finally:
+                    pool.close()
+                    pool.join()
+                times.extend(stage_times)
+                best.append(min(stage_times))
+                peaks.append(peak)
+        results[name] = {'p50_ms': percentile(times, 50) * 1000, 'p95_ms': percentile(times, 95) * 1000,
+                         'best_ms': percentile(best, 50) * 1000, 'throughput': len(times) / sum(times),
+                         'peak_mb': max(peaks)}
+    prepared.clear()
+    return results
+
+
+def print_stages(results, baseline=None):
+    """
+    Prints the results of bench_stages(), next to the baseline if any.
+    """
+    print('%-16s %10s %10s %10s %12s %10s %10s' % ('stage', 'p50', 'p95', 'best', 'photos/s', 'peak', 'base best'))
+    for name, _ in STAGES:
+        res = results[name]
+        base = (baseline or {}).get(name)
+        print('%-16s %8.2fms %8.2fms %8.2fms %12.1f %8.1fMB %10s' % (name, res['p50_ms'], res['p95_ms'],
+                                                                      res['best_ms'], res['throughput'],
+                                                                      res['peak_mb'],
+                                                                      '%.2fms' % base['best_ms'] if base else '-'))
+
+
+def regressions(results, baseline, threshold=REGRESSION_THRESHOLD):
+    """
+    Compares the results of bench_stages() against a baseline.
+    Latency is compared on the best time of each photo, which is far steadier than percentiles of all runs, and a stage
+    only regresses if it also grew by more than MIN_LATENCY_REGRESSION_MS, so that stages of a few milliseconds do
+    not fail on noise.
+    :param results: results of bench_stages()
+    :param baseline: results of an earlier run of bench_stages()
+    :param threshold: allowed relative growth of the latency and of the peak memory of each stage
+    :return: list of (stage name, description of the regression) tuples
+    """
+    found = []
+    for name in sorted(set(results) & set(baseline)):
+        res, base = results[name], baseline[name]
+        if res['best_ms'] > base['best_ms'] * (1 + threshold) + MIN_LATENCY_REGRESSION_MS:
+            found.append((name, 'best %.2fms, baseline %.2fms' % (res['best_ms'], base['best_ms'])))
+        if res['peak_mb'] > base['peak_mb'] * (1 + threshold) + MIN_MEMORY_REGRESSION_MB:
+            found.append((name, 'peak %.1fMB, baseline %.1fMB' % (res['peak_mb'], base['peak_mb'])))
+    return found
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the bubble sheet scanner.')
+    parser.add_argument('images', nargs='*', help='test photos (default: tst/* and the sample sheet)')
+    parser.add_argument('--readers', action='store_true', help='compare the answer readers against the loops instead')
+    parser.add_argument('--grading', type=int, nargs='?', const=GRADING_SHEETS, metavar='SHEETS',
+                        help='grade a synthetic exam of that many sheets instead (default: %d)' % GRADING_SHEETS)
+    parser.add_argument('--variants', default=','.join(VARIANTS), help='comma separated variants of each photo')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='least timed runs of each stage on each photo')
+    parser.add_argument('--baseline', help='baseline file to compare against')
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help='allowed relative regression against the baseline')
+    parser.add_argument('--save-baseline', help='file to store the results in as the new baseline')
+    args = parser.parse_args()
+
+    if args.readers:
+        sys.exit(0 if bench_readers(args.images or DEFAULT_IMAGES) else 1)
+    if args.grading:
+        sys.exit(0 if bench_grading(args.grading) else 1)
+
+    images, variants = args.images or DEFAULT_IMAGES, args.variants.split(',')
+    stage_baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        # timings of other photos, or of a baseline saved before best times were kept, are not comparable
+        if saved['images'] != images or saved['variants'] != variants or \
+                any('best_ms' not in stage for stage in saved['stages'].values()):
+            sys.exit('baseline %s was not saved for these photos and variants; save it again' % args.baseline)
+        stage_baseline = saved['stages']
+    stage_results = bench_stages(images, variants, args.repeat)
+    print_stages(stage_results, stage_baseline)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({'images': images, 'variants': variants,
+                       'repeat': args.repeat, 'stages': stage_results}, f, indent=2, sort_keys=True)
+    if stage_baseline is not None:
+        found = regressions(stage_results, stage_baseline, args.threshold)
+        # Timings drift with the load of the machine for seconds at a time, so a stage only fails the gate if it is
+        # still slower when measured again, keeping its best over all measurements
+        for _ in range(CONFIRM_ROUNDS):
+            if not found:
+                break
+            names = set(name for name, _ in found)
+            print('measuring %s again' % ', '.join(sorted(names)))
+            for name, res in bench_stages(images, variants, args.repeat, names).items():
+                stage_results[name]['best_ms'] = min(stage_results[name]['best_ms'], res['best_ms'])
+                stage_results[name]['peak_mb'] = min(stage_results[name]['peak_mb'], res['peak_mb'])
+            found = regressions(stage_results, stage_baseline, args.threshold)
+        for name, line in found:
+            print('REGRESSION %s: %s' % (name, line))
+        sys.exit(1 if found else 0)
@@ -0,0 +1,166 @@
+import httplib
+import socket
+import urllib
+import urlparse
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+
+MAX_IMAGE_BYTES = 32 * 1024 * 1024
+READ_CHUNK_BYTES = 64 * 1024
+CONNECT_TIMEOUT = 5         # seconds
+READ_TIMEOUT = 30           # seconds, between two reads of a response
+MAX_IDLE_PER_HOST = 4
+MAX_REDIRECTS = 3
+FETCH_WORKERS = 8
+
+##
+# Fetches photos over keep-alive connections pooled per host, with timeouts and a size cap.
+##
+
+
+def read_capped(f, max_bytes=MAX_IMAGE_BYTES):
+    """
+    Reads a file-like object into memory, refusing to hold more than a given size.
+    :param f: file-like object
+    :param max_bytes: maximum number of bytes
+    :return: content as a string
+    """
+    buf = StringIO()
+    size = 0
+    while True:
+        chunk = f.read(READ_CHUNK_BYTES)
+        if not chunk:
+            return buf.getvalue()
+        size += len(chunk)
+        if size > max_bytes:
+            raise ValueError('image larger than %d bytes' % max_bytes)
+        buf.write(chunk)
+
+
+class ConnectionPool:
+    """
+    Idle keep-alive HTTP connections, kept per (scheme, host, port) so that later requests to the same host skip the
+    connection setup.
+    """
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, max_idle=MAX_IDLE_PER_HOST):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = Lock()
+
+    def get(self, host_key):
+        """
+        Takes an idle connection to a host, or opens a new one.
+        :param host_key: (scheme, host, port) as a tuple
+        :return: (connection, whether it was reused) as a tuple
+        """
+        with self.lock:
+            conns = self.idle.get(host_key)
+            if conns:
+                return conns.pop(), True
+        scheme, host, port = host_key
+        conn_class = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        conn = conn_class(host, port, timeout=self.connect_timeout)
+        conn.connect()
+        conn.sock.settimeout(self.read_timeout)
+        return conn, False
+
+    def put(self, host_key, conn):
+        """
+        Returns a connection whose response has been read completely, closing it if enough are idle already.
+        """
+        with self.lock:
+            conns = self.idle.setdefault(host_key, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+
+class Fetcher:
+    """
+    Downloads photos over pooled connections, one at a time or many concurrently.
+    URLs that are not http(s) are opened with urllib, as the server always did.
+    """
+    def __init__(self, max_bytes=MAX_IMAGE_BYTES, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 workers=FETCH_WORKERS):
+        self.max_bytes = max_bytes
+        self.connections = ConnectionPool(connect_timeout, read_timeout)
+        self.workers = ThreadPool(workers)
+
+    def fetch(self, url, redirects=MAX_REDIRECTS):
+        """
+        Downloads a photo into memory.
+        :param url: URL of the photo
+        :param redirects: number of redirects still allowed
+        :return: content as a string
+        """
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            return read_capped(urllib.urlopen(url), self.max_bytes)
+        host_key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        path = urlparse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+
+        conn, reused = self.connections.get(host_key)
+        try:
+            try:
+                conn.request('GET', path, headers={'Connection': 'keep-alive'})
+                resp = conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                if not reused:
+                    raise
+                # the server closed the idle connection meanwhile
+                conn.close()
+                conn, reused = self.connections.get(host_key)
+                conn.request('GET', path, headers={'Connection': 'keep-alive'})
+                resp = conn.getresponse()
+
+            length = resp.getheader('Content-Length')
+            if length is not None and int(length) > self.max_bytes:
+                raise ValueError('image larger than %d bytes' % self.max_bytes)
+            body = read_capped(resp, self.max_bytes)
+        except:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self.connections.put(host_key, conn)
+
+        if resp.status in (301, 302, 303, 307, 308) and resp.getheader('Location') and redirects > 0:
+            return self.fetch(urlparse.urljoin(url, resp.getheader('Location')), redirects - 1)
+        if resp.status != 200:
+            raise IOError('HTTP %d fetching %s' % (resp.status, url))
+        return body
+
+    def fetch_all(self, urls):
+        """
+        Downloads many photos concurrently, yielding each as soon as it and the ones before it are in, so that the
+        caller can start on the first photos while the later ones are still downloading.
+        :param urls: list of URLs
+        :return: iterator of (url, content, error) tuples in the order of the URLs, where content is None on failure
+        """
+        return self.workers.imap(self.try_fetch, urls)
+
+    def try_fetch(self, url):
+        """
+        Downloads a photo, reporting failure instead of raising.
+        :return: (url, content, error) as a tuple, where content is None on failure
+        """
+        try:
+            return url, self.fetch(url), None
+        except Exception as e:
+            return url, None, e
+
+    def close(self):
+        self.workers.terminate()
+        self.connections.close()
@@ -0,0 +1,85 @@
+import argparse
+import os
+import urllib
+import urllib2
+from threading import Thread, Lock
+from time import time
+
+##
+# Sends scan requests to a running scanner server and reports status codes and latencies.
+# Usage: python load_test.py [--requests n] [--concurrency c] [--image path]
+##
+
+DEFAULT_SERVER = 'http://localhost:8012/scanner/check-now'
+DEFAULT_IMAGE = 'tst/test0.jpeg'
+REQUEST_TIMEOUT = 120
+
+
+def percentile(values, q):
+    """
+    Picks the q-th percentile of a list of values by the nearest rank.
+    :return: percentile, or None for an empty list
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q / 100.0 * len(values)))]
+
+
+def run(server, params, num_requests, concurrency):
+    """
+    Sends requests from `concurrency` threads until `num_requests` have been sent.
+    :param server: URL of the scanner endpoint
+    :param params: dictionary of GET parameters
+    :return: (list of (status code, latency in seconds) tuples, total time in seconds) as a tuple
+    """
+    url = server + '?' + urllib.urlencode(params)
+    results = []
+    lock = Lock()
+    remaining = [num_requests]
+
+    def client():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            start = time()
+            try:
+                status = urllib2.urlopen(url, timeout=REQUEST_TIMEOUT).getcode()
+            except urllib2.HTTPError as e:
+                status = e.code
+            except Exception:
+                status = 0
+            with lock:
+                results.append((status, time() - start))
+
+    start = time()
+    threads = [Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test a running scanner server.')
+    parser.add_argument('--server', default=DEFAULT_SERVER)
+    parser.add_argument('--image', default=DEFAULT_IMAGE, help='photo path or URL the server downloads')
+    parser.add_argument('--key', default='')
+    parser.add_argument('--num-papers', type=int, default=2)
+    parser.add_argument('--num-questions', type=int, default=30)
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=1, help='1 sends sequential traffic')
+    args = parser.parse_args()
+
+    image = args.image if '://' in args.image else os.path.abspath(args.image)
+    query = {'url': image, 'key': args.key, 'num_papers': args.num_papers, 'num_questions': args.num_questions}
+    res, elapsed = run(args.server, query, args.requests, args.concurrency)
+
+    for code in sorted(set(status for status, _ in res)):
+        latencies = [latency for status, latency in res if status == code]
+        print('%s: %d request(s), p50 %.3fs, p95 %.3fs' % (code or 'error', len(latencies),
+                                                           percentile(latencies, 50), percentile(latencies, 95)))
+    print('%d request(s) in %.2fs, %.1f request(s)/s' % (len(res), elapsed, len(res) / elapsed))
@@ -1,7 +1,53 @@
 from __future__ import absolute_import  # fix known bug of PyCharm
 import unittest
 import cv2
-from src.raw_photo import RawPhoto
+import csv
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from src.raw_photo import RawPhoto, scan_photo, find_quads
+from src.result_cache import ResultCache, cache_key
+from src.instrument import Metrics, current, recording
+from src.stream import StreamScanner, scan_video
+from src.layout import load_layout, TEMPLATE_DIR
+from src.paper_scan import trim_offsets, threshold_region, CONFIDENCE_THRESHOLD
+from src.scan_result import ScanResult, encode_answers
+from src.grading import grade_exam
+from src.job_queue import JobQueue
+from src.export import pyarrow
+import simple_server
+import httplib
+import time
+import batch_scan
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from SimpleHTTPServer import SimpleHTTPRequestHandler
+from threading import Thread
+from image_fetch import Fetcher, MAX_IMAGE_BYTES
+from benchmark import DEFAULT_IMAGES, loop_read_single, loop_read_multiple, loop_trim_offsets
+
+# Answers to the first 30 questions of the two papers of tst/test2.jpeg, which are marked twice or left blank from
+# question 16 on
+TEST2_ANSWERS = [['A', 'B', 'C', 'D', 'E', 'E', 'D', 'C', 'B', 'A', 'A', 'B', 'C', 'D', 'E',
+                  'AE', 'BD', 'C', 'BCD', 'ABCD', '', 'AE', 'BD', 'C', 'BD', 'AE', 'A', 'B', 'E', 'D'],
+                 ['A', 'C', 'D', 'D', 'A', 'C', 'B', 'A', 'C', 'D', 'D', 'A', 'C', 'D', 'D',
+                  'AB', 'AC', 'AE', 'AE', '', '', '', '', '', '', '', '', '', '', '']]
+
+
+class KeepAliveHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass
 
 
 class MyTestCase(unittest.TestCase):
@@ -28,11 +74,425 @@ class MyTestCase(unittest.TestCase):
     #     print(res)
 
     def test_normal3(self):
-        test_img = cv2.imread("tst/test4.jpeg", 0)
+        test_img = cv2.imread("tst/test2.jpeg", 0)
         rp = RawPhoto(test_img, 2, 30)
-        res = rp.dump_data()
+        res = json.loads(rp.dump_data())
         rp.paper_objs = []
-        print(res)
+        self.assertEqual('', res['metadata'])
+        self.assertEqual(TEST2_ANSWERS, [paper['answers'][:30] for paper in res['papers']])
+        # Only the answers read again are uncertain, among them all that are not a single option
+        for paper in res['papers']:
+            uncertain = [c < CONFIDENCE_THRESHOLD for c in paper['confidence'][:30]]
+            self.assertEqual([False] * 15, uncertain[:15])
+            self.assertTrue(all(u for u, answer in zip(uncertain, paper['answers']) if len(answer) != 1))
+        for paper in res['papers']:
+            self.assertEqual([0] * 30, paper['answers'][30:])
+
+    def test_vectorized_readers(self):
+        for path in DEFAULT_IMAGES:
+            rp = RawPhoto(cv2.imread(path, 0), 1, keep_images=True)
+            paper = rp.paper_objs[0]
+            paper.read_all_answers_single()
+            self.assertEqual(loop_read_single(paper), paper.marked_ans[:paper.num_questions])
+            paper.raad_all_answers_multiple()
+            self.assertEqual(loop_read_multiple(paper), paper.marked_ans[:paper.num_questions])
+
+    def test_trim_offsets(self):
+        for path in DEFAULT_IMAGES:
+            paper = RawPhoto(cv2.imread(path, 0), 1, keep_images=True).paper_objs[0]
+            offsets = trim_offsets(paper.thr_img, paper.table_boxes(paper.ans_boxes))
+            for i in range(len(paper.ans_boxes)):
+                self.assertEqual(loop_trim_offsets(paper.ans_imgs_thr[i]), tuple(offsets[i]))
+
+    def test_threshold_region(self):
+        test_img = cv2.imread('tst/test0.jpeg', 0)
+        h, w = test_img.shape[:2]
+        thr_img = cv2.adaptiveThreshold(test_img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 29, 8)
+        for up, down, left, right in [(0, h, 0, w), (0, 40, 0, 40), (h - 40, h, w - 40, w), (300, 900, 100, 600),
+                                      (5, 6, 700, w)]:
+            self.assertTrue(np.array_equal(thr_img[up:down, left:right],
+                                           threshold_region(test_img, (up, down, left, right))))
+
+    def test_table_candidates(self):
+        rp = RawPhoto(np.full((600, 400), 200, np.uint8), 2)
+        self.assertEqual([], rp.results)
+        self.assertEqual('2 paper(s) not detected.\n', rp.metadata)
+        rp = RawPhoto(cv2.imread("tst/test2.jpeg", 0), 5)
+        self.assertEqual(2, len(rp.results))
+        self.assertEqual('3 paper(s) not detected.\n', rp.metadata)
+
+        # Tables of equal area are both kept, and small quadrilaterals are not candidates
+        thr_img = np.zeros((400, 400), np.uint8)
+        for x in [20, 220]:
+            cv2.rectangle(thr_img, (x, 50), (x + 150, 300), 255, 3)
+        cv2.rectangle(thr_img, (100, 350), (110, 360), 255, 1)
+        candidates = find_quads(thr_img)
+        self.assertTrue(all(area > 0.01 * thr_img.size for area, _ in candidates))
+        self.assertEqual(candidates[0][0], candidates[1][0])
+        self.assertEqual([18, 218], sorted(cv2.boundingRect(approx)[0] for _, approx in candidates[:2]))
+        self.assertEqual(2, len(find_quads(thr_img, k=2)))
+
+    def test_compact_results(self):
+        labels = 'ABCDE'
+        answers = encode_answers(['A', 'BD', '', 'ABCDE', 0], labels)
+        self.assertEqual(np.uint8, answers.dtype)
+        self.assertEqual([1, 10, 0, 31, 0], answers.tolist())
+        result = ScanResult('12345', '678', answers, 4, labels)
+        self.assertEqual(['A', 'BD', '', 'ABCDE', 0], result.marked_answers())
+        self.assertEqual(['test_id', 'paper_id', 'answers', 'metadata'], list(result.to_dict()))
+
+        # Only the results of the papers are kept unless the images are asked for
+        rp = RawPhoto(cv2.imread("tst/test2.jpeg", 0), 2)
+        self.assertEqual([], rp.paper_objs)
+        kept = RawPhoto(cv2.imread("tst/test2.jpeg", 0), 2, keep_images=True)
+        self.assertEqual(rp.dump_data(), kept.dump_data())
+
+    def test_grading(self):
+        labels = load_layout().option_labels
+        papers = [ScanResult('11111', '001', encode_answers(['A', 'B', 'C', 0], labels), 3, labels),
+                  ScanResult('11111', '002', encode_answers(['A', 'C', '', 0], labels), 3, labels),
+                  {'test_id': u'11111', 'paper_id': u'003', 'answers': [u'AB', u'B', u'C', 0]},
+                  ScanResult('?????', '???', encode_answers(['B', 'B', 'D', 0], labels), 3, labels),
+                  ScanResult('22222', '004', encode_answers(['B', 'B', 'D', 0], labels), 3, labels)]
+        reports, ungraded = grade_exam(papers, {'11111': 'ABC'})
+        self.assertEqual([3, 4], ungraded.tolist())
+        report = reports['11111']
+        self.assertEqual([0, 1, 2], report.papers.tolist())
+        self.assertEqual([3, 1, 2], report.scores.tolist())
+        self.assertEqual(3, report.max_score)
+        self.assertEqual([2 / 3.0] * 3, report.difficulty.tolist())
+        self.assertEqual([-0.5, 0.5, 0.5], np.round(report.discrimination, 6).tolist())
+        self.assertEqual([0, 1, 0, 0, 0], report.distractor_counts[0].tolist())
+        self.assertEqual([3, 1, 0, 0, 0], report.option_counts[0].tolist())
+        self.assertEqual([0, 0, 1], report.blank_counts.tolist())
+        self.assertEqual([1, 0, 0], report.multiple_counts.tolist())
+
+        # Unread test ids can be graded against a key, and questions left out of the key are not scored
+        reports, ungraded = grade_exam(papers, {'11111': ['A', '', 'C']}, unknown_key='11111')
+        self.assertEqual([4], ungraded.tolist())
+        report = reports['11111']
+        self.assertEqual([2, 1, 1, 0], report.scores.tolist())
+        self.assertEqual(2, report.max_score)
+        self.assertIsNone(report.to_dict()['difficulty'][1])
+
+    def test_uncertain_answers(self):
+        # The marked paper is read once; the blank one is read again every way and comes out blank
+        with recording() as recorder:
+            rp = RawPhoto(cv2.imread('tst/source10.png', 0), 2)
+        marked, blank = rp.results
+        self.assertTrue(marked.confidence.min() >= CONFIDENCE_THRESHOLD)
+        self.assertEqual(['A', 'C', 'D', 'D', 'A', 'C', 'B'], marked.marked_answers()[:7])
+        self.assertEqual([''] * 60, blank.marked_answers())
+        self.assertEqual(60, recorder.counts['answers_uncertain'])
+        self.assertEqual(60, recorder.counts['answers_blank'])
+        self.assertEqual(1, recorder.counts['rewarps'])
+        self.assertIn('recover', recorder.timings)
+
+    def test_probe_brightness_near_edges(self):
+        test_img = cv2.imread('tst/test0.jpeg', 0)
+        h, w = test_img.shape[:2]
+        rp = RawPhoto(test_img, 1)
+        brightnesses = rp.probe_brightness([(0, 0), (w - 1, h - 1), (w + 100, h + 100)], 30)
+        self.assertAlmostEqual(brightnesses[0], test_img[:30, :30].mean())
+        self.assertAlmostEqual(brightnesses[1], test_img[h - 31:, w - 31:].mean())
+        self.assertEqual(brightnesses[2], float('inf'))
+
+    def test_probe_brightness_of_large_photos(self):
+        # The sum of a bright 12 MP photo does not fit 32 bits
+        rp = RawPhoto(np.full((3000, 4000), 200, np.uint8), 0)
+        pts = [(3960, 2690), (3990, 2990), (10, 10)]
+        self.assertEqual([200.0] * 3, list(rp.probe_brightness(pts, 30)))
+
+    def test_coarse_to_fine_detection(self):
+        for path in DEFAULT_IMAGES:
+            test_img = cv2.imread(path, 0)
+            res = RawPhoto(test_img.copy(), 1).dump_data()
+            for detect_size in [960, 640]:
+                self.assertEqual(res, RawPhoto(test_img.copy(), 1, detect_size=detect_size).dump_data())
+
+    def test_concurrent_papers(self):
+        for path in DEFAULT_IMAGES:
+            test_img = cv2.imread(path, 0)
+            res = RawPhoto(test_img, 2).dump_data()
+            for executor in ['thread', 'process']:
+                self.assertEqual(res, RawPhoto(test_img, 2, executor=executor).dump_data())
+
+    def test_batch_scan_resumes(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            output_path = os.path.join(tmp_dir, 'out.jsonl')
+            export_path = os.path.join(tmp_dir, 'out.csv')
+            inputs = DEFAULT_IMAGES + [os.path.join(tmp_dir, 'missing.jpg')]
+            self.assertEqual((4, 1), batch_scan.run(inputs[:3] + inputs[-1:], output_path, 1, workers=2,
+                                                    export_path=export_path))
+            self.assertEqual((len(inputs) - 4, 0), batch_scan.run(inputs, output_path, 1, workers=2,
+                                                                  export_path=export_path))
+            with open(output_path) as f:
+                records = [json.loads(line) for line in f]
+            self.assertEqual(sorted(inputs), sorted(record['path'] for record in records))
+
+            # One row per paper, with the answers of the JSON lines
+            with open(export_path) as f:
+                rows = list(csv.reader(f))
+            self.assertEqual(['path', 'paper', 'test_id', 'paper_id', 'q1'], rows[0][:5])
+            self.assertEqual(4 + 60, len(rows[0]))
+            papers = dict((record['path'], record['result']['papers']) for record in records if 'result' in record)
+            self.assertEqual(sum(len(p) for p in papers.values()), len(rows) - 1)
+            for row in rows[1:]:
+                paper = papers[row[0]][int(row[1])]
+                self.assertEqual([paper['test_id'], paper['paper_id']], row[2:4])
+                self.assertEqual(paper['answers'], row[4:])
+
+            # A photo exported by a run stopped before writing its line is scanned again but not exported again
+            with open(output_path) as f:
+                lines = f.readlines()
+            with open(output_path, 'w') as f:
+                f.writelines(line for line in lines if DEFAULT_IMAGES[0] not in line)
+            self.assertEqual((1, 0), batch_scan.run(inputs, output_path, 1, workers=2, export_path=export_path))
+            with open(export_path) as f:
+                self.assertEqual(rows, list(csv.reader(f)))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_batch_scan_refuses_parquet_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            export_path = os.path.join(tmp_dir, 'out.parquet')
+            open(export_path, 'w').close()
+            with self.assertRaises(ValueError):
+                batch_scan.open_export(export_path, 60)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @unittest.skipIf(pyarrow is None, 'Parquet export needs pyarrow')
+    def test_batch_scan_resumes_parquet(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            output_path = os.path.join(tmp_dir, 'out.jsonl')
+            export_path = os.path.join(tmp_dir, 'out.parquet')
+            self.assertEqual((2, 0), batch_scan.run(DEFAULT_IMAGES[:2], output_path, 1, workers=2,
+                                                    export_path=export_path))
+            self.assertEqual((len(DEFAULT_IMAGES) - 2, 0), batch_scan.run(DEFAULT_IMAGES, output_path, 1, workers=2,
+                                                                          export_path=export_path))
+            # Each run adds a part, and the rows of the first run are kept
+            self.assertEqual(['part-0.parquet', 'part-1.parquet'], sorted(os.listdir(export_path)))
+            with open(output_path) as f:
+                records = [json.loads(line) for line in f]
+            papers = dict((record['path'], record['result']['papers']) for record in records)
+            rows = pyarrow.parquet.read_table(export_path).to_pydict()
+            self.assertEqual(sum(len(p) for p in papers.values()), len(rows['path']))
+            self.assertEqual(set(DEFAULT_IMAGES), set(rows['path']))
+
+            # A photo exported by a run stopped before writing its line is scanned again but not exported again
+            with open(output_path, 'w') as f:
+                f.writelines(json.dumps(record) + '\n' for record in records if record['path'] != DEFAULT_IMAGES[0])
+            self.assertEqual((1, 0), batch_scan.run(DEFAULT_IMAGES, output_path, 1, workers=2,
+                                                    export_path=export_path))
+            self.assertEqual(rows, pyarrow.parquet.read_table(export_path).to_pydict())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_layout_cache(self):
+        layout = load_layout()
+        self.assertIs(layout, load_layout('standard60'))
+        self.assertEqual((60, 4), layout.field_boxes.shape)
+        self.assertEqual([294, 372, 75, 239], list(layout.field_boxes[0]))
+        other = load_layout(os.path.join(TEMPLATE_DIR, 'standard60.json'))
+        self.assertTrue(np.array_equal(layout.field_boxes, other.field_boxes))
+
+    def test_fetch_from_local_server(self):
+        httpd = LocalServer(('localhost', 0), KeepAliveHandler)
+        Thread(target=httpd.serve_forever).start()
+        fetcher = Fetcher(max_bytes=1024 * 1024)
+        try:
+            base = 'http://localhost:%d/' % httpd.server_address[1]
+            urls = [base + path for path in DEFAULT_IMAGES]
+            for url, content, error in fetcher.fetch_all(urls + [base + 'tst/missing.png']):
+                if url.endswith('missing.png'):
+                    self.assertIsNone(content)
+                else:
+                    with open(url[len(base):], 'rb') as f:
+                        self.assertEqual(f.read(), content)
+            self.assertEqual(open(DEFAULT_IMAGES[0], 'rb').read(), fetcher.fetch(urls[0]))
+            self.assertTrue(fetcher.connections.idle)
+            fetcher.max_bytes = 1024
+            self.assertRaises(ValueError, fetcher.fetch, urls[0])
+        finally:
+            fetcher.close()
+            httpd.shutdown()
+            httpd.server_close()
+
+    def test_get_failures(self):
+        # Photos that cannot be downloaded, are too large or cannot be decoded are answered with an error status
+        files = LocalServer(('localhost', 0), KeepAliveHandler)
+        Thread(target=files.serve_forever).start()
+        httpd = simple_server.ScannerServer(('localhost', 0))
+        Thread(target=httpd.serve_forever).start()
+        try:
+            base = 'http://localhost:%d/' % files.server_address[1]
+            statuses = []
+            for url, max_bytes in [(base + 'tst/missing.png', None), (base + DEFAULT_IMAGES[0], 1024),
+                                   (base + 'README.md', None)]:
+                httpd.fetcher.max_bytes = max_bytes or MAX_IMAGE_BYTES
+                conn = httplib.HTTPConnection('localhost', httpd.server_address[1])
+                conn.request('GET', '%s?key=testkey&num_papers=1&num_questions=30&url=%s' % (simple_server.URL_HEAD,
+                                                                                             url))
+                statuses.append(conn.getresponse().status)
+                conn.close()
+            self.assertEqual([502, 413, 400], statuses)
+        finally:
+            for server in [httpd, files]:
+                server.shutdown()
+                server.server_close()
+
+    def test_result_cache(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            db_path = os.path.join(tmp_dir, 'cache.db')
+            cache = ResultCache(db_path=db_path)
+            test_img = cv2.imread(DEFAULT_IMAGES[0], 0)
+            res = scan_photo(test_img, 1, cache=cache)
+            self.assertEqual(res, RawPhoto(test_img, 1).dump_data())
+            self.assertEqual(res, scan_photo(test_img.copy(), 1, cache=cache))
+            self.assertEqual((1, 1), (cache.hits, cache.misses))
+            scan_photo(test_img, 1, 30, cache=cache)
+            self.assertEqual((1, 2), (cache.hits, cache.misses))
+            cache.close()
+
+            # Results survive a restart, and the memory tier evicts the least recently used results
+            cache = ResultCache(max_bytes=10, db_path=db_path)
+            self.assertEqual(res, scan_photo(test_img, 1, cache=cache))
+            self.assertEqual((0, 1, 0), (cache.hits, cache.disk_hits, cache.misses))
+            self.assertEqual(0, cache.stats()['bytes'])
+            cache.put('a', '12345')
+            cache.put('b', '12345')
+            cache.get('a')
+            cache.put('c', '12345')
+            self.assertEqual(['a', 'c'], list(cache.entries))
+            self.assertNotEqual(cache_key('x', 1, 30), cache_key('x', 2, 30))
+            cache.close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_job_queue(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            # A job failing transiently is retried after a delay until it runs out of attempts; finished jobs expire
+            db_path = os.path.join(tmp_dir, 'jobs.db')
+            jobs = JobQueue(db_path, max_attempts=2, retry_delay=0.2, result_ttl=0.5)
+            job_id, queued = jobs.submit({'num_papers': 1}, url='http://localhost/missing.png')
+            self.assertTrue(queued)
+            self.assertEqual((job_id, {'num_papers': 1}, None, 'http://localhost/missing.png'), jobs.claim(0))
+            self.assertTrue(jobs.fail(job_id, 'timed out', True))
+            self.assertIsNone(jobs.claim(0))
+            self.assertEqual(job_id, jobs.claim(1)[0])
+            self.assertFalse(jobs.fail(job_id, 'timed out', True))
+            self.assertEqual({'job_id': job_id, 'status': 'failed', 'attempts': 2, 'error': 'timed out'},
+                             jobs.get(job_id))
+            time.sleep(0.5)
+            self.assertIsNone(jobs.get(job_id))
+
+            # The idempotency key of an expired job queues a new job, even before the expired one is deleted
+            job_id, _ = jobs.submit({'num_papers': 1}, image='photo', idempotency_key='photo-1')
+            jobs.complete(jobs.claim(0)[0], '{}')
+            time.sleep(0.5)
+            resubmitted, queued = jobs.submit({'num_papers': 1}, image='photo', idempotency_key='photo-1')
+            self.assertTrue(queued)
+            self.assertNotEqual(job_id, resubmitted)
+            self.assertEqual('queued', jobs.get(resubmitted)['status'])
+            jobs.complete(jobs.claim(0)[0], '{}')
+
+            # Jobs running when the server stopped are queued again after a restart
+            job_id, _ = jobs.submit({'num_papers': 1}, image='photo')
+            jobs.claim(0)
+            jobs.close()
+            jobs = JobQueue(db_path)
+            self.assertEqual({'job_id': job_id, 'status': 'queued', 'attempts': 1}, jobs.get(job_id))
+            jobs.close()
+
+            # Photos submitted are scanned in the background, once per idempotency key
+            httpd = simple_server.ScannerServer(('localhost', 0), jobs=JobQueue(':memory:'))
+            Thread(target=httpd.serve_forever).start()
+            try:
+                with open(DEFAULT_IMAGES[0], 'rb') as f:
+                    photo = f.read()
+                path = '%s?key=testkey&num_papers=2&num_questions=30' % simple_server.URL_JOBS
+                submitted = []
+                for _ in range(2):
+                    conn = httplib.HTTPConnection('localhost', httpd.server_address[1])
+                    conn.request('POST', path, photo, {'Idempotency-Key': 'photo-1'})
+                    resp = conn.getresponse()
+                    submitted.append(json.loads(resp.read())['job_id'])
+                    self.assertEqual('%s/%s' % (simple_server.URL_JOBS, submitted[0]), resp.getheader('Location'))
+                    conn.close()
+                self.assertEqual(submitted[0], submitted[1])
+                for _ in range(100):
+                    conn = httplib.HTTPConnection('localhost', httpd.server_address[1])
+                    conn.request('GET', '%s/%s?key=testkey' % (simple_server.URL_JOBS, submitted[0]))
+                    job = json.loads(conn.getresponse().read())
+                    conn.close()
+                    if job['status'] == 'done':
+                        break
+                    time.sleep(0.1)
+                expected = json.loads(RawPhoto(cv2.imread(DEFAULT_IMAGES[0], 0), 2, 30).dump_data())
+                self.assertEqual(expected, job['result'])
+                self.assertEqual({'queued': 0, 'running': 0, 'done': 1, 'failed': 0}, httpd.stats()['jobs'])
+            finally:
+                httpd.shutdown()
+                httpd.server_close()
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_stage_recording(self):
+        test_img = cv2.imread(DEFAULT_IMAGES[0], 0)
+        res = RawPhoto(test_img, 2).dump_data()
+        self.assertIsNone(current())
+        metrics = Metrics()
+        for executor in [None, 'process']:
+            with recording() as recorder:
+                self.assertEqual(res, RawPhoto(test_img, 2, executor=executor).dump_data())
+            self.assertIsNone(current())
+            for name in ['threshold', 'find_contours', 'orientate', 'warp', 'paper_threshold', 'read_answers',
+                         'read_datamatrix']:
+                self.assertIn(name, recorder.timings)
+            self.assertEqual(2, recorder.counts['papers'])
+            metrics.observe(recorder)
+        text = metrics.render({'queue_depth': 0})
+        self.assertIn('scanner_stage_seconds_count{stage="warp"} 2', text)
+        self.assertIn('scanner_stage_seconds_bucket{stage="warp",le="+Inf"} 2', text)
+        self.assertIn('scanner_events_total{event="papers"} 4', text)
+        data_dict = json.loads(simple_server.add_timings(res, recorder))
+        self.assertEqual(json.loads(res)['papers'], data_dict['papers'])
+        self.assertEqual(recorder.breakdown(), data_dict['timings'])
+
+    def test_stream_tracking(self):
+        test_img = cv2.imread("tst/test2.jpeg", 0)
+        h, w = test_img.shape[:2]
+
+        def frame(k, jump=0):
+            motion = cv2.getRotationMatrix2D((w / 2.0, h / 2.0), 0.3 * k, 1.0)
+            motion[:, 2] += (3 * k + jump, 2 * k)
+            return cv2.warpAffine(test_img, motion, (w, h), borderMode=cv2.BORDER_REPLICATE)
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            video_path = os.path.join(tmp_dir, 'stream.avi')
+            writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'MJPG'), 10, (w, h), False)
+            for k in range(8):
+                writer.write(frame(k))
+            writer.release()
+            results = list(scan_video(video_path, 2, 30))
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(1, len(results))
+        self.assertEqual(TEST2_ANSWERS, [paper['answers'][:30] for paper in json.loads(results[0][1])['papers']])
+
+        scanner = StreamScanner(2, 30)
+        for k in range(4):
+            scanner.feed(frame(k))
+        self.assertEqual(1, scanner.detections)
+        scanner.feed(frame(4, jump=150))
+        self.assertEqual(2, scanner.detections)
 
 
 if __name__ == '__main__':
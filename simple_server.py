@@ -1,21 +1,335 @@
+import argparse
+import cgi
 import cv2
+import json
+import signal
 import SocketServer
-import urllib
-from os import remove
+import numpy as np
+from cStringIO import StringIO
+from multiprocessing import Pool, TimeoutError, cpu_count
+from threading import BoundedSemaphore, Event, Lock, Thread
 from time import time
 from BaseHTTPServer import BaseHTTPRequestHandler
 from urlparse import parse_qs
+from pylibdmtx.pylibdmtx import decode
+from image_fetch import Fetcher, MAX_IMAGE_BYTES
 from src.options import DEBUG, API_KEYS
-from src.raw_photo import RawPhoto
+from src.raw_photo import RawPhoto, THR_MAX_VAL, THR_BLOCK_SIZE, THR_OFFSET
+from src.result_cache import ResultCache, cache_key, CACHE_MAX_BYTES
+from src.job_queue import JobQueue, JOB_DB, DONE, FAILED
+from src.instrument import Metrics, Recorder, stage, count, current, recording
 
 PORT = 8012
 URL_HEAD = '/scanner/check-now'
+URL_STATS = '/scanner/stats'
+URL_METRICS = '/metrics'
+URL_JOBS = '/scanner/jobs'
+
+# Concurrent mode
+NUM_WORKERS = cpu_count()
+QUEUE_SIZE = 16             # requests allowed to wait for a worker before the server answers 503
+RETRY_AFTER = 2             # seconds
+SCAN_TIMEOUT = 60           # seconds
+
+# Jobs
+JOB_POLL_INTERVAL = 1       # seconds a job worker waits for a job before checking whether the server stops
+JOB_RETRY_AFTER = 1         # seconds clients are told to wait before polling a job again
 
 ##
 # requires `options.py` in src which contains API_KEY and DEBUG option
 ##
 
 
+def warm_up():
+    """
+    Prepares a worker process before its first request: leaves keyboard interrupts to the server and runs OpenCV and
+    pylibdmtx once so that their lazy initialization is not paid by a request.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    blank = np.full((64, 64), 255, np.uint8)
+    cv2.adaptiveThreshold(blank, THR_MAX_VAL, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, THR_BLOCK_SIZE,
+                          THR_OFFSET)
+    decode(blank, timeout=1, max_count=1)
+
+
+def scan_bytes(image_bytes, num_papers, num_questions, submitted=None):
+    """
+    Decodes a photo from memory and scans it. Runs in a worker process in concurrent mode.
+    :param image_bytes: encoded photo
+    :param num_papers: number of papers in the photo
+    :param num_questions: number of questions in the paper
+    :param submitted: time the scan was submitted to the worker pool, to record how long it waited for a worker
+    :return: (JSON string of the result, Recorder object of the stages of the scan) as a tuple
+    """
+    with recording() as recorder:
+        if submitted is not None:
+            recorder.add('queue', max(0.0, time() - submitted))
+        with stage('decode_image'):
+            test_img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if test_img is None:
+            raise ValueError('could not decode image')
+        with stage('scan'):
+            rp = RawPhoto(test_img, num_papers, num_questions)
+            res = rp.dump_data()
+    return res, recorder
+
+
+def error_result(metadata):
+    """
+    Builds the result of a photo that could not be scanned at all.
+    :param metadata: reason, as a line of metadata
+    :return: JSON string of the result
+    """
+    return json.dumps({'papers': [], 'metadata': metadata})
+
+
+def add_timings(res, recorder):
+    """
+    Adds the time spent per stage to a result. The entry is appended to the JSON object of the result as it is, so
+    that the result is neither parsed nor serialized again.
+    :param res: JSON string of the result, an object
+    :param recorder: Recorder object of the request
+    :return: JSON string of the result with a `timings` entry, in milliseconds per stage
+    """
+    return '%s, "timings": %s}' % (res.rstrip()[:-1], json.dumps(recorder.breakdown()))
+
+
+def job_json(job):
+    """
+    Formats a job for the API.
+    :param job: dictionary of the job, as JobQueue.get() returns it
+    :return: JSON string of the job, with its result included as is
+    """
+    job = dict(job)
+    res = job.pop('result', None)
+    data = json.dumps(job)
+    return data if res is None else '%s, "result": %s}' % (data[:-1], res)
+
+
+class ScannerServer(SocketServer.TCPServer):
+    """
+    Serves one request at a time and scans photos in the serving thread, and jobs in a background thread.
+    """
+    allow_reuse_address = True
+    pool = None
+    slots = None
+    fetcher = None
+    cache = None
+    jobs = None
+    metrics = None
+    workers = 1
+
+    def __init__(self, server_address, cache=None, jobs=None, job_workers=1):
+        """
+        :param server_address: (host, port) as a tuple
+        :param cache: ResultCache object photos submitted again are answered from, None to always scan
+        :param jobs: JobQueue object of the photos submitted to be scanned in the background, None to only scan
+                     photos while the client waits
+        :param job_workers: number of threads taking jobs from the queue
+        """
+        SocketServer.TCPServer.__init__(self, server_address, RequestHandler)
+        self.fetcher = Fetcher()
+        self.cache = cache
+        self.jobs = jobs
+        self.metrics = Metrics()
+        self.requests_active = 0
+        self.scans_pending = 0
+        self.gauge_lock = Lock()
+        self.stopping = Event()
+        self.job_threads = []
+        if jobs is not None:
+            for _ in range(job_workers):
+                thread = Thread(target=self.run_jobs)
+                thread.daemon = True
+                thread.start()
+                self.job_threads.append(thread)
+
+    def acquire_slot(self):
+        """
+        Reserves room for a request to be scanned.
+        :return: False if the server is full and the request should be turned away
+        """
+        if self.slots is not None and not self.slots.acquire(False):
+            self.metrics.count('requests_rejected')
+            return False
+        self.track('requests_active', 1)
+        return True
+
+    def release_slot(self):
+        self.track('requests_active', -1)
+        if self.slots is not None:
+            self.slots.release()
+
+    def track(self, gauge, delta):
+        """
+        Adjusts one of the gauges of the server.
+        :param gauge: 'requests_active' or 'scans_pending'
+        :param delta: amount to add
+        """
+        with self.gauge_lock:
+            setattr(self, gauge, getattr(self, gauge) + delta)
+
+    def scan(self, image_bytes, num_papers, num_questions):
+        """
+        Scans an encoded photo.
+        :return: JSON string of the result
+        """
+        return self.submit(image_bytes, num_papers, num_questions)()
+
+    def submit(self, image_bytes, num_papers, num_questions):
+        """
+        Starts scanning an encoded photo, unless its result is cached.
+        :return: function that waits for and returns the JSON string of the result
+        """
+        if self.cache is None:
+            return self.start_scan(image_bytes, num_papers, num_questions)
+        key = cache_key(image_bytes, num_papers, num_questions)
+        res = self.cache.get(key)
+        if res is not None:
+            count('cache_hits')
+            return lambda: res
+        count('cache_misses')
+        wait = self.start_scan(image_bytes, num_papers, num_questions)
+
+        def wait_and_cache():
+            scanned = wait()
+            self.cache.put(key, scanned)
+            return scanned
+        return wait_and_cache
+
+    def start_scan(self, image_bytes, num_papers, num_questions):
+        """
+        Starts scanning an encoded photo, in a worker process if there is a pool.
+        The stages recorded by the scan are added to those of the calling thread when the result is collected.
+        :return: function that waits for and returns the JSON string of the result
+        """
+        if self.pool is None:
+            res, recorder = scan_bytes(image_bytes, num_papers, num_questions)
+            if current() is not None:
+                current().merge(recorder)
+            return lambda: res
+        self.track('scans_pending', 1)
+        pending = self.pool.apply_async(scan_bytes, (image_bytes, num_papers, num_questions, time()))
+
+        def wait():
+            try:
+                with stage('wait'):
+                    res, recorder = pending.get(SCAN_TIMEOUT)
+            finally:
+                self.track('scans_pending', -1)
+            if current() is not None:
+                current().merge(recorder)
+            return res
+        return wait
+
+    def run_jobs(self):
+        """
+        Scans the jobs of the queue one after the other until the server stops.
+        """
+        while not self.stopping.is_set():
+            job = self.jobs.claim(JOB_POLL_INTERVAL)
+            if job is not None:
+                self.run_job(*job)
+
+    def run_job(self, job_id, params, image_bytes, url):
+        """
+        Makes an attempt at a job, and records its result or why it failed. Photos that cannot be downloaded or
+        scanned in time are tried again later; photos that cannot be decoded are not.
+        :param job_id: id of the job
+        :param params: dictionary of the scan parameters of the job
+        :param image_bytes: encoded photo, or None to download it from `url`
+        :param url: url of the photo
+        """
+        recorder = Recorder()
+        try:
+            with recording(recorder), stage('job'):
+                if image_bytes is None:
+                    try:
+                        with stage('download'):
+                            image_bytes = self.fetcher.fetch(url)
+                    except ValueError as e:
+                        self.fail_job(job_id, 'Could not download photo: %s' % e)
+                        return
+                    except Exception as e:
+                        count('downloads_failed')
+                        self.fail_job(job_id, 'Could not download photo: %s' % e, True)
+                        return
+                try:
+                    res = self.scan(image_bytes, params['num_papers'], params['num_questions'])
+                except ValueError:
+                    count('photos_undecodable')
+                    self.fail_job(job_id, 'Could not decode photo.')
+                    return
+                except TimeoutError:
+                    count('scans_timed_out')
+                    self.fail_job(job_id, 'Scan timed out.', True)
+                    return
+                self.jobs.complete(job_id, res)
+                count('jobs_done')
+        except Exception as e:
+            self.fail_job(job_id, 'Could not scan photo: %r' % e, True)
+        finally:
+            self.metrics.observe(recorder)
+
+    def fail_job(self, job_id, error, transient=False):
+        if self.jobs.fail(job_id, error, transient):
+            self.metrics.count('jobs_retried')
+        else:
+            self.metrics.count('jobs_failed')
+
+    def stats(self):
+        """
+        :return: dictionary of the counters of the server
+        """
+        return {'cache': self.cache.stats() if self.cache is not None else None,
+                'jobs': self.jobs.stats() if self.jobs is not None else None}
+
+    def gauges(self):
+        """
+        :return: dictionary of the current load of the server, for the metrics
+        """
+        with self.gauge_lock:
+            gauges = {'requests_active': self.requests_active,
+                      'scans_pending': self.scans_pending,
+                      'queue_depth': max(0, self.scans_pending - self.workers)}
+        if self.jobs is not None:
+            gauges['jobs_queued'] = self.jobs.stats()['queued']
+        return gauges
+
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        # Jobs being scanned are left running in the queue, to be scanned again after a restart
+        self.stopping.set()
+        for thread in self.job_threads:
+            thread.join()
+        self.fetcher.close()
+        if self.cache is not None:
+            self.cache.close()
+        if self.jobs is not None:
+            self.jobs.close()
+
+
+class ConcurrentScannerServer(SocketServer.ThreadingMixIn, ScannerServer):
+    """
+    Serves each request in its own thread and scans photos in a pool of pre-forked, warmed up worker processes.
+    At most `workers + queue_size` requests are handled at once; further requests are answered with 503. Jobs are
+    taken from the queue by `workers` threads, each waiting for its scan in the pool.
+    """
+    daemon_threads = True
+
+    def __init__(self, server_address, workers=NUM_WORKERS, queue_size=QUEUE_SIZE, cache=None, jobs=None):
+        # the pool has to be up before the job threads start scanning
+        self.pool = Pool(workers, warm_up)
+        ScannerServer.__init__(self, server_address, cache, jobs, workers)
+        self.workers = workers
+        self.slots = BoundedSemaphore(workers + queue_size)
+
+    def server_close(self):
+        ScannerServer.server_close(self)
+        self.pool.terminate()
+        self.pool.join()
+
+
 class RequestHandler(BaseHTTPRequestHandler):
     def do_HEAD(self):
         self.send_response(200)
@@ -23,66 +337,298 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
 
     def do_GET(self):
-        if DEBUG:
-            print(self.path, self.path[:len(URL_HEAD)])
-
-        # has to start with URL_HEAD
-        if self.path[:len(URL_HEAD)] != URL_HEAD:
-            print('> != URL_HEAD')
+        """
+        Scans the photo at `url`. Given several `url` parameters, downloads the photos concurrently, scans each as soon
+        as it is in, and returns {"results": [...]} with one result per photo in the same order.
+        """
+        if self.path == URL_STATS:
+            self.send_result(json.dumps(self.server.stats()))
             return
-        # has to have GET parameter
-        if len(self.path) <= len(URL_HEAD) + 1:  # 1 filters `?`
-            print('> NO GET PARAMETER')
+        if self.path == URL_METRICS:
+            self.send_result(self.server.metrics.render(self.server.gauges()), 'text/plain; version=0.0.4')
             return
-        # has to have url in GET parameter
-        get_param = parse_qs(self.path[len(URL_HEAD) + 1:])
-        if 'url' not in get_param or 'key' not in get_param or \
-                        'num_papers' not in get_param or 'num_questions' not in get_param:
-            print('> `url`, `key`, `num_papers`, OR `num_questions` NOT IN PARAMETERS')
+        if self.path.startswith(URL_JOBS + '/') and self.server.jobs is not None:
+            self.poll_job()
             return
+        get_param = self.parse_params(['url'])
+        if get_param is None:
+            return
+        urls = get_param['url']
 
-        url = get_param['url'][0]
-        key = get_param['key'][0]
-        num_papers = get_param['num_papers'][0]
-        num_questions = get_param['num_questions'][0]
+        if not self.server.acquire_slot():
+            self.send_busy()
+            return
+        recorder = Recorder()
+        try:
+            with recording(recorder), stage('request'):
+                print('> PROCESSING REQUEST...')
+                if len(urls) == 1:
+                    try:
+                        print('  - downloading raw photo')
+                        with stage('download'):
+                            image_bytes = self.server.fetcher.fetch(urls[0])
+                    except ValueError:
+                        print('> PICTURE TOO LARGE %s' % urls[0])
+                        count('downloads_failed')
+                        self.send_error(413)
+                        return
+                    except:
+                        print('> CANNOT DOWNLOAD PICTURE %s' % urls[0])
+                        count('downloads_failed')
+                        self.send_error(502)
+                        return
+                    try:
+                        res = self.process(image_bytes, get_param['num_papers'], get_param['num_questions'])
+                    except ValueError:
+                        print('> CANNOT DECODE PICTURE %s' % urls[0])
+                        count('photos_undecodable')
+                        self.send_error(400)
+                        return
+                    except TimeoutError:
+                        print('> SCAN TIMED OUT %s' % urls[0])
+                        count('scans_timed_out')
+                        self.send_error(504)
+                        return
+                else:
+                    res = self.process_all(urls, get_param['num_papers'], get_param['num_questions'])
+        finally:
+            self.server.release_slot()
+            self.server.metrics.observe(recorder)
+        self.send_result(add_timings(res, recorder) if get_param['timings'] else res)
 
-        if key not in API_KEYS:
-            print('> WRONG API KEY')
+    def do_POST(self):
+        """
+        Scans a photo uploaded as the request body, either raw or as the file of a multipart/form-data form.
+        The query string carries `key`, `num_papers` and `num_questions` as for GET requests.
+        """
+        if self.path.startswith(URL_JOBS) and self.server.jobs is not None:
+            self.submit_job()
+            return
+        get_param = self.parse_params([])
+        if get_param is None:
+            self.send_error(400)
+            return
+        try:
+            length = int(self.headers.getheader('Content-Length'))
+        except (TypeError, ValueError):
+            self.send_error(411)
+            return
+        if length > MAX_IMAGE_BYTES:
+            print('> UPLOAD TOO LARGE')
+            self.send_error(413)
             return
 
+        if not self.server.acquire_slot():
+            self.send_busy()
+            return
+        recorder = Recorder()
         try:
-            num_papers = int(num_papers)
-            num_questions = int(num_questions)
-        except:
-            print('> CANNOT PARSE `num_papers` OR `num_questions` TO INTEGERS')
+            with recording(recorder), stage('request'):
+                print('> PROCESSING REQUEST...')
+                body = self.read_upload(length)
+                try:
+                    res = self.process(body, get_param['num_papers'], get_param['num_questions'])
+                except ValueError:
+                    print('> CANNOT DECODE PICTURE')
+                    count('photos_undecodable')
+                    self.send_error(400)
+                    return
+                except TimeoutError:
+                    print('> SCAN TIMED OUT')
+                    count('scans_timed_out')
+                    self.send_error(504)
+                    return
+        finally:
+            self.server.release_slot()
+            self.server.metrics.observe(recorder)
+        self.send_result(add_timings(res, recorder) if get_param['timings'] else res)
+
+    def submit_job(self):
+        """
+        Queues a photo to be scanned in the background and answers at once with the id of the job, to be polled at
+        `URL_JOBS/<job_id>`. The photo is uploaded as for POST requests to URL_HEAD, or given by a `url` parameter.
+        A job submitted again with the same `Idempotency-Key` header is not queued again; its current state is returned
+        instead.
+        """
+        get_param = self.parse_params([], URL_JOBS)
+        if get_param is None:
+            self.send_error(400)
+            return
+        url = parse_qs(self.path.partition('?')[2]).get('url', [None])[0]
+        try:
+            length = int(self.headers.getheader('Content-Length') or (0 if url else None))
+        except (TypeError, ValueError):
+            self.send_error(411)
+            return
+        if length > MAX_IMAGE_BYTES:
+            print('> UPLOAD TOO LARGE')
+            self.send_error(413)
+            return
+        image_bytes = self.read_upload(length) if length else None
+        if image_bytes is None and url is None:
+            print('> NO PHOTO TO SCAN')
+            self.send_error(400)
+            return
+
+        idempotency_key = self.headers.getheader('Idempotency-Key')
+        if idempotency_key is not None:
+            # clients only share keys with themselves
+            idempotency_key = '%s:%s' % (get_param['key'], idempotency_key)
+        params = {'num_papers': get_param['num_papers'], 'num_questions': get_param['num_questions']}
+        submitted = self.server.jobs.submit(params, image_bytes, url, idempotency_key)
+        if submitted is None:
+            self.server.metrics.count('jobs_rejected')
+            self.send_busy()
+            return
+        job_id, queued = submitted
+        if queued:
+            self.server.metrics.count('jobs_submitted')
+        job = self.server.jobs.get(job_id)
+        if job is None:
+            # expired as it was submitted
+            self.send_error(500)
             return
+        self.send_result(job_json(job), status=202 if job['status'] not in (DONE, FAILED) else 200,
+                         headers={'Location': '%s/%s' % (URL_JOBS, job_id)})
+
+    def poll_job(self):
+        """
+        Answers the state of the job at `URL_JOBS/<job_id>?key=api_key`: its `status` ('queued', 'running', 'done' or
+        'failed'), its `attempts`, and its `result` once done or its `error` once failed. Unknown and expired jobs are
+        answered with 404.
+        """
+        path, _, query = self.path.partition('?')
+        if parse_qs(query).get('key', [None])[0] not in API_KEYS:
+            print('> WRONG API KEY')
+            self.send_error(400)
+            return
+        job = self.server.jobs.get(path[len(URL_JOBS) + 1:])
+        if job is None:
+            self.send_error(404)
+            return
+        headers = {}
+        if job['status'] not in (DONE, FAILED):
+            headers['Retry-After'] = str(JOB_RETRY_AFTER)
+        self.send_result(job_json(job), headers=headers)
+
+    def read_upload(self, length):
+        """
+        Reads a photo uploaded as the request body, either raw or as the file of a multipart/form-data form.
+        :param length: length of the body
+        :return: encoded photo
+        """
+        print('  - reading uploaded photo')
+        with stage('upload'):
+            body = self.rfile.read(length)
+        content_type = self.headers.getheader('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            form = cgi.FieldStorage(fp=StringIO(body), headers=self.headers,
+                                    environ={'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': content_type,
+                                             'CONTENT_LENGTH': str(length)})
+            parts = [part for part in (form.list or []) if part.filename] or form.list or []
+            body = parts[0].value if parts else ''
+        return body
+
+    def parse_params(self, required, head=URL_HEAD):
+        """
+        Checks the path and parses the GET parameters shared by all requests.
+        :param required: names of the parameters required besides `key`, `num_papers` and `num_questions`
+        :param head: path the request has to be for
+        :return: dictionary of the parameters, with `num_papers` and `num_questions` as integers, a list of values
+                 for each of the other required parameters and whether the optional `timings` parameter asks for the
+                 time spent per stage, or None if the request is invalid
+        """
+        if DEBUG:
+            print(self.path, self.path[:len(head)])
+
+        # has to start with head
+        if self.path[:len(head)] != head:
+            print('> != %s' % head)
+            return None
+        # has to have GET parameter
+        if len(self.path) <= len(head) + 1:  # 1 filters `?`
+            print('> NO GET PARAMETER')
+            return None
+        query = parse_qs(self.path[len(head) + 1:])
+        names = required + ['key', 'num_papers', 'num_questions']
+        if any(name not in query for name in names):
+            print('> %s NOT IN PARAMETERS' % ', '.join('`%s`' % name for name in names))
+            return None
+        get_param = dict((name, query[name] if name in required else query[name][0]) for name in names)
+        get_param['timings'] = query.get('timings', ['0'])[0] not in ('0', 'false')
+
+        if get_param['key'] not in API_KEYS:
+            print('> WRONG API KEY')
+            return None
 
-        print('> PROCESSING REQUEST...')
         try:
-            print('  - downloading raw photo')
-            filepath = 'tmp/%d.jpg' % int(time() * 1000)
-            f = open(filepath, 'wb+')
-            f.write(urllib.urlopen(url).read())
-            f.close()
+            get_param['num_papers'] = int(get_param['num_papers'])
+            get_param['num_questions'] = int(get_param['num_questions'])
         except:
-            print('> CANNOT DOWNLOAD PICTURE %s' % url)
-            return
+            print('> CANNOT PARSE `num_papers` OR `num_questions` TO INTEGERS')
+            return None
+        return get_param
 
-        # CV stuff
+    def process(self, image_bytes, num_papers, num_questions):
+        """
+        Scans a photo held in memory.
+        :return: JSON string of the result
+        """
         print('  - cv module starts')
-        test_img = cv2.imread(filepath, 0)
-        rp = RawPhoto(test_img, num_papers, num_questions)
-        res = rp.dump_data()
-        rp.paper_objs = []
+        res = self.server.scan(image_bytes, num_papers, num_questions)
         print('  - cv module done')
         print(res)
+        return res
 
-        # clean up
-        remove(filepath)
+    def process_all(self, urls, num_papers, num_questions):
+        """
+        Downloads many photos concurrently and scans each one as soon as it has arrived.
+        :return: JSON string of the results
+        """
+        print('  - downloading %d raw photos' % len(urls))
+        pending = []
+        downloads = self.server.fetcher.fetch_all(urls)
+        for _ in urls:
+            # only the time spent waiting for the next photo adds to the request
+            with stage('download'):
+                url, image_bytes, error = next(downloads)
+            if image_bytes is None:
+                print('> CANNOT DOWNLOAD PICTURE %s (%s)' % (url, error))
+                count('downloads_failed')
+                pending.append(lambda: error_result('Could not download photo.\n'))
+                continue
+            try:
+                pending.append(self.server.submit(image_bytes, num_papers, num_questions))
+            except ValueError:
+                count('photos_undecodable')
+                pending.append(lambda: error_result('Could not decode photo.\n'))
+        res = []
+        for i, url in enumerate(urls):
+            try:
+                res.append(pending[i]())
+            except ValueError:
+                print('> CANNOT DECODE PICTURE %s' % url)
+                count('photos_undecodable')
+                res.append(error_result('Could not decode photo.\n'))
+            except TimeoutError:
+                print('> SCAN TIMED OUT %s' % url)
+                count('scans_timed_out')
+                res.append(error_result('Scan timed out.\n'))
+        print('  - cv module done')
+        return '{"results": [%s]}' % ', '.join(res)
 
+    def send_busy(self):
+        print('> SERVER FULL')
+        self.send_response(503)
+        self.send_header("Retry-After", str(RETRY_AFTER))
+        self.end_headers()
+
+    def send_result(self, res, content_type="text/json", status=200, headers=None):
         # send header
-        self.send_response(200)
-        self.send_header("Content-type", "text/json")
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
         self.end_headers()
 
         self.wfile.write(res)
@@ -90,5 +636,25 @@ class RequestHandler(BaseHTTPRequestHandler):
 
 
 if __name__ == '__main__':
-    httpd = SocketServer.TCPServer(("", PORT), RequestHandler)
-    httpd.serve_forever()
+    parser = argparse.ArgumentParser(description='Serve the bubble sheet scanner over HTTP.')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--sequential', action='store_true', help='handle one request at a time, as a single process')
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS, help='number of scanning worker processes')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE, help='requests allowed to wait for a worker')
+    parser.add_argument('--cache-bytes', type=int, default=CACHE_MAX_BYTES,
+                        help='size of the results cached in memory, 0 to disable the cache')
+    parser.add_argument('--cache-db', default=None, help='SQLite file to also cache results in across restarts')
+    parser.add_argument('--job-db', default=JOB_DB,
+                        help="SQLite file the queue of jobs is kept in across restarts, ':memory:' to lose it on exit")
+    args = parser.parse_args()
+
+    result_cache = ResultCache(args.cache_bytes, args.cache_db) if args.cache_bytes or args.cache_db else None
+    job_queue = JobQueue(args.job_db)
+    if args.sequential:
+        httpd = ScannerServer(("", args.port), result_cache, job_queue)
+    else:
+        httpd = ConcurrentScannerServer(("", args.port), args.workers, args.queue_size, result_cache, job_queue)
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
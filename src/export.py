@@ -0,0 +1,132 @@
+import csv
+import os
+import re
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Parquet export is optional
+    pyarrow = None
+
+# Columnar export
+PARQUET_ROW_GROUP = 10000   # papers per row group of a Parquet file
+PARQUET_PART = 'part-%d.parquet'
+PARQUET_PART_PATTERN = re.compile(r'^part-(\d+)\.parquet$')
+
+##
+# Exports scan results in bulk, one row per paper with the photo it was found in, its ids and one column per question,
+# so that the results of a whole exam can be loaded into a spreadsheet or a gradebook at once.
+##
+
+
+def export_columns(num_questions):
+    """
+    :param num_questions: number of questions in the papers
+    :return: list of the column names of an export
+    """
+    return ['path', 'paper', 'test_id', 'paper_id'] + ['q%d' % (i + 1) for i in range(num_questions)]
+
+
+def export_rows(path, results, num_questions):
+    """
+    Lays out the results of a photo as export rows.
+    :param path: path of the photo
+    :param results: list of ScanResult objects of the papers of the photo
+    :param num_questions: number of questions in the papers
+    :return: iterator of rows, each a list of values in the order of export_columns()
+    """
+    for i, result in enumerate(results):
+        answers = result.marked_answers()[:num_questions]
+        yield [path, i, result.test_id, result.paper_id] + answers + [''] * (num_questions - len(answers))
+
+
+class CsvExport:
+    """
+    Writes results to a CSV file as they come, a photo at a time.
+    """
+    def __init__(self, out, num_questions, header=True, exported=None):
+        """
+        :param out: file object opened for writing
+        :param num_questions: number of questions in the papers
+        :param header: whether to write the row of column names first, e.g. not when appending to an earlier export
+        :param exported: set of the paths of the photos already in the file, whose results are not written again
+        """
+        self.out = out
+        self.writer = csv.writer(out)
+        self.num_questions = num_questions
+        self.exported = exported or set()
+        if header:
+            self.writer.writerow(export_columns(num_questions))
+
+    def write(self, path, results):
+        """
+        Writes the results of a photo.
+        :param path: path of the photo
+        :param results: list of ScanResult objects of the papers of the photo
+        """
+        if path in self.exported:
+            return
+        self.writer.writerows(export_rows(path, results, self.num_questions))
+        self.out.flush()
+
+    def close(self):
+        self.out.close()
+
+
+class ParquetExport:
+    """
+    Writes results to a directory of Parquet files, a row group of PARQUET_ROW_GROUP papers at a time. Each export
+    writes a new part file, so that resuming a run never overwrites what earlier runs exported; the directory reads as
+    one table, e.g. with pyarrow.parquet.read_table(). Needs pyarrow.
+    """
+    def __init__(self, directory, num_questions, row_group=PARQUET_ROW_GROUP):
+        """
+        :param directory: path of the directory of part files, created if missing
+        :param num_questions: number of questions in the papers
+        :param row_group: number of papers buffered before a row group is written
+        """
+        if pyarrow is None:
+            raise ImportError('Parquet export needs pyarrow')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        parts = [int(match.group(1)) for match in map(PARQUET_PART_PATTERN.match, os.listdir(directory)) if match]
+        # photos in the parts of earlier runs are not written again
+        self.exported = set()
+        for part in parts:
+            table = pyarrow.parquet.read_table(os.path.join(directory, PARQUET_PART % part), columns=['path'])
+            self.exported.update(table.to_pydict()['path'])
+        self.path = os.path.join(directory, PARQUET_PART % (max(parts) + 1 if parts else 0))
+        self.columns = export_columns(num_questions)
+        fields = [pyarrow.field(name, pyarrow.string()) for name in self.columns]
+        fields[1] = pyarrow.field('paper', pyarrow.int32())
+        self.schema = pyarrow.schema(fields)
+        self.writer = None  # opened with the first row group, so that a run exporting nothing adds no part
+        self.num_questions = num_questions
+        self.row_group = row_group
+        self.rows = []
+
+    def write(self, path, results):
+        """
+        Buffers the results of a photo, and writes a row group once enough papers are buffered.
+        :param path: path of the photo
+        :param results: list of ScanResult objects of the papers of the photo
+        """
+        if path in self.exported:
+            return
+        self.rows.extend(export_rows(path, results, self.num_questions))
+        if len(self.rows) >= self.row_group:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = [pyarrow.array(list(column), type=field.type)
+                   for column, field in zip(zip(*self.rows), self.schema)]
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(self.path, self.schema)
+        self.writer.write_table(pyarrow.Table.from_arrays(columns, schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
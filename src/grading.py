@@ -0,0 +1,160 @@
+import numpy as np
+from layout import load_layout, DEFAULT_TEMPLATE
+from scan_result import encode_answers
+
+# Test id of the papers whose datamatrix could not be read
+UNKNOWN_TEST_ID = '?????'
+
+##
+# Grades scanned papers against an answer key per test id and analyses the questions of each test. The answers of all
+# papers of a test are laid out as one papers x questions matrix of option bitmasks, as ScanResult holds them, so that
+# scores, difficulty, discrimination and option counts are computed with a few array operations whatever the number of
+# papers.
+##
+
+
+def encode_key(key, option_labels):
+    """
+    Packs an answer key into bitmasks.
+    :param key: string of one option label per question, or list of the correct options of each question, each a
+                string of option labels (several for questions with more than one correct option), '' or 0 for
+                questions not scored
+    :param option_labels: labels of the options
+    :return: array of bitmasks, 0 for questions not scored
+    """
+    return encode_answers(list(key), option_labels)
+
+
+def answer_matrix(papers, num_questions, option_labels):
+    """
+    Lays out the answers of papers as a matrix.
+    :param papers: list of ScanResult objects, or of paper dictionaries as ScanResult.to_dict() returns them, whose
+                   answers are strings of option labels (several for multiple marks, '' if blank) padded with 0
+    :param num_questions: number of questions, i.e. columns of the matrix
+    :param option_labels: labels of the options
+    :return: papers x questions array of the bitmasks of the marked options
+    """
+    dtype = np.uint8 if len(option_labels) <= 8 else np.uint32
+    matrix = np.zeros((len(papers), num_questions), dtype=dtype)
+    # bitmask of each distinct answer string found in paper dictionaries
+    masks = {0: 0, '': 0}
+    bits = dict((label, 1 << j) for j, label in enumerate(option_labels))
+    for i, paper in enumerate(papers):
+        if isinstance(paper, dict):
+            answers = paper['answers'][:num_questions]
+            for ans in answers:
+                if ans not in masks:
+                    masks[ans] = sum(bits[label] for label in ans)
+            answers = [masks[ans] for ans in answers]
+        else:
+            answers = paper.answers[:num_questions]
+        matrix[i, :len(answers)] = answers
+    return matrix
+
+
+class GradeReport:
+    """
+    Scores of the papers of one test and analysis of its questions.
+    Statistics of questions that are not scored, and discriminations of questions every paper got right (or wrong),
+    are NaN.
+    """
+    test_id = None
+    key = None
+    papers = None
+    scores = None
+    max_score = 0
+    difficulty = None
+    discrimination = None
+    option_counts = None
+    distractor_counts = None
+    blank_counts = None
+    multiple_counts = None
+
+    def __init__(self, test_id, key, papers, answers, option_labels):
+        """
+        Grades the papers of a test.
+        :param test_id: id of the test
+        :param key: array of the bitmasks of the correct options of each question, as encode_key() returns
+        :param papers: array of the indices of the papers of the test among all papers graded
+        :param answers: papers x questions array of the bitmasks of the marked options, as answer_matrix() returns
+        :param option_labels: labels of the options
+        """
+        self.test_id = test_id
+        self.key = key
+        self.papers = papers
+        answers = answers[:, :len(key)]
+        scored = key != 0
+
+        # A question is right when exactly the options of the key are marked
+        correct = (answers == key) & scored
+        self.scores = correct.sum(1)
+        self.max_score = int(scored.sum())
+
+        # Difficulty is the share of papers getting a question right, discrimination the point-biserial correlation
+        # between getting it right and the score on the other questions
+        x = correct.astype(np.float64)
+        rest = self.scores[:, np.newaxis] - x
+        x -= x.mean(0)
+        rest -= rest.mean(0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.difficulty = np.where(scored, correct.mean(0), np.nan)
+            self.discrimination = np.where(scored, (x * rest).sum(0) / np.sqrt((x * x).sum(0) * (rest * rest).sum(0)),
+                                           np.nan)
+
+        # Papers marking each option of each question, among them the wrong options, blanks and multiple marks
+        marked = (answers[:, :, np.newaxis] >> np.arange(len(option_labels), dtype=answers.dtype)) & 1
+        self.option_counts = marked.sum(0, dtype=np.int64)
+        in_key = (key[:, np.newaxis] >> np.arange(len(option_labels), dtype=key.dtype)) & 1
+        self.distractor_counts = np.where(in_key, 0, self.option_counts)
+        num_marked = marked.sum(2, dtype=np.int64)
+        self.blank_counts = (num_marked == 0).sum(0)
+        self.multiple_counts = (num_marked > 1).sum(0)
+
+    def to_dict(self):
+        """
+        :return: dictionary of the report, with lists in place of arrays and None in place of NaN
+        """
+        def stats(values):
+            return [None if np.isnan(v) else round(v, 4) for v in values.tolist()]
+        return {'test_id': self.test_id,
+                'papers': self.papers.tolist(),
+                'scores': self.scores.tolist(),
+                'max_score': self.max_score,
+                'difficulty': stats(self.difficulty),
+                'discrimination': stats(self.discrimination),
+                'option_counts': self.option_counts.tolist(),
+                'distractor_counts': self.distractor_counts.tolist(),
+                'blank_counts': self.blank_counts.tolist(),
+                'multiple_counts': self.multiple_counts.tolist()}
+
+
+def grade_exam(papers, answer_keys, unknown_key=None, template=DEFAULT_TEMPLATE):
+    """
+    Grades the papers of an exam, each against the answer key of its test id.
+    :param papers: list of ScanResult objects or of paper dictionaries, as answer_matrix() takes them
+    :param answer_keys: dictionary of the answer key of each test id, as encode_key() takes them
+    :param unknown_key: test id of the key to grade the papers whose test id could not be read against, e.g. when all
+                        papers are of the same test; None leaves them ungraded
+    :param template: id of the sheet format of the papers
+    :return: (dictionary of the GradeReport of each test id with papers, array of the indices of the papers left
+             ungraded) as a tuple
+    """
+    option_labels = load_layout(template).option_labels
+    keys = dict((test_id, encode_key(key, option_labels)) for test_id, key in answer_keys.items())
+    num_questions = max([len(key) for key in keys.values()] or [0])
+    answers = answer_matrix(papers, num_questions, option_labels)
+
+    test_ids = [paper['test_id'] if isinstance(paper, dict) else paper.test_id for paper in papers]
+    if unknown_key is not None:
+        test_ids = [unknown_key if test_id == UNKNOWN_TEST_ID else test_id for test_id in test_ids]
+    ids, groups = np.unique(test_ids, return_inverse=True)
+    reports = {}
+    ungraded = []
+    for g, test_id in enumerate(ids.tolist()):
+        members = np.flatnonzero(groups == g)
+        if test_id not in keys:
+            ungraded.append(members)
+            continue
+        reports[test_id] = GradeReport(test_id, keys[test_id], members, answers[members], option_labels)
+    ungraded = np.sort(np.concatenate(ungraded)) if ungraded else np.zeros(0, dtype=int)
+    return reports, ungraded
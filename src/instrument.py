@@ -0,0 +1,194 @@
+from contextlib import contextmanager
+from threading import local, Lock
+from timeit import default_timer
+
+# Histogram buckets of the metrics, upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+##
+# Times the stages of a scan and counts its events. Nothing is recorded unless the calling thread is inside
+# recording(), so that instrumented code costs a thread-local lookup per stage otherwise.
+##
+
+recorders = local()
+
+
+class Recorder:
+    """
+    Time spent per stage and number of events of one scan, summed over the papers of a photo.
+    Only plain dictionaries are held, so that a recorder can be returned from a worker process.
+    """
+    def __init__(self):
+        self.timings = {}
+        self.counts = {}
+
+    def add(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def merge(self, other):
+        """
+        Adds the timings and counts of another recorder, e.g. of a paper scanned in a worker.
+        """
+        for name, seconds in other.timings.items():
+            self.add(name, seconds)
+        for name, n in other.counts.items():
+            self.count(name, n)
+
+    def breakdown(self):
+        """
+        :return: dictionary of the time spent per stage, in milliseconds
+        """
+        return dict((name, round(seconds * 1000, 3)) for name, seconds in self.timings.items())
+
+
+class Stage(object):
+    """
+    Context manager adding the time spent inside it to a stage of a recorder.
+    """
+    __slots__ = ('recorder', 'name', 'start')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = default_timer()
+
+    def __exit__(self, *exc_info):
+        self.recorder.add(self.name, default_timer() - self.start)
+
+
+class NoStage(object):
+    """
+    Context manager doing nothing, used when the thread is not recording.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_STAGE = NoStage()
+
+
+def current():
+    """
+    :return: Recorder object the calling thread records to, None if it is not recording
+    """
+    return getattr(recorders, 'recorder', None)
+
+
+@contextmanager
+def recording(recorder=None):
+    """
+    Records the stages timed and the events counted by the calling thread while inside the context.
+    :param recorder: Recorder object to add to, a new one if None
+    :return: the Recorder object
+    """
+    previous = current()
+    recorders.recorder = recorder or Recorder()
+    try:
+        yield recorders.recorder
+    finally:
+        recorders.recorder = previous
+
+
+def stage(name):
+    """
+    Times a stage of a scan: `with stage('threshold'): ...`
+    :param name: name of the stage
+    :return: context manager
+    """
+    recorder = getattr(recorders, 'recorder', None)
+    if recorder is None:
+        return NO_STAGE
+    return Stage(recorder, name)
+
+
+def count(name, n=1):
+    """
+    Counts an event of a scan.
+    :param name: name of the event
+    :param n: number of events
+    """
+    recorder = getattr(recorders, 'recorder', None)
+    if recorder is not None:
+        recorder.count(name, n)
+
+
+class Histogram:
+    """
+    Cumulative latency histogram with fixed buckets.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.total = 0
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(self.buckets) and seconds > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += seconds
+        self.total += 1
+
+
+class Metrics:
+    """
+    Aggregates the recorders of all requests served: one latency histogram per stage and a counter per event.
+    Safe to share between threads.
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.counts = {}
+        self.lock = Lock()
+
+    def observe(self, recorder):
+        """
+        Adds the timings and counts of one request.
+        :param recorder: Recorder object of the request
+        """
+        with self.lock:
+            for name, seconds in recorder.timings.items():
+                if name not in self.histograms:
+                    self.histograms[name] = Histogram()
+                self.histograms[name].observe(seconds)
+            for name, n in recorder.counts.items():
+                self.counts[name] = self.counts.get(name, 0) + n
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def render(self, gauges=None):
+        """
+        Formats the metrics in the Prometheus text format.
+        :param gauges: dictionary of further current values to include, e.g. the queue depth
+        :return: text of the metrics
+        """
+        lines = ['# TYPE scanner_stage_seconds histogram']
+        with self.lock:
+            for name in sorted(self.histograms):
+                histogram = self.histograms[name]
+                cumulative = 0
+                for bound, n in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += n
+                    lines.append('scanner_stage_seconds_bucket{stage="%s",le="%s"} %d' % (name, bound, cumulative))
+                lines.append('scanner_stage_seconds_sum{stage="%s"} %f' % (name, histogram.sum))
+                lines.append('scanner_stage_seconds_count{stage="%s"} %d' % (name, histogram.total))
+            lines.append('# TYPE scanner_events_total counter')
+            for name in sorted(self.counts):
+                lines.append('scanner_events_total{event="%s"} %d' % (name, self.counts[name]))
+        for name in sorted(gauges or {}):
+            lines.append('# TYPE scanner_%s gauge' % name)
+            lines.append('scanner_%s %s' % (name, gauges[name]))
+        return '\n'.join(lines) + '\n'
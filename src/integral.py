@@ -0,0 +1,17 @@
+import numpy as np
+
+
+def rect_sums(int_img, top, bottom, left, right):
+    """
+    Sums the pixels of many rectangles at once by looking up their corners in an integral image.
+    Bounds can be arrays of any broadcastable shapes; bottom and right bounds are exclusive.
+    :param int_img: integral image of the picture, as returned by cv2.integral(); its depth has to hold the sum of the
+                    whole picture, e.g. cv2.CV_64F for photos of many megapixels, as a wrapped table gives wrong sums
+    :param top: top bounds of the rectangles
+    :param bottom: bottom bounds of the rectangles
+    :param left: left bounds of the rectangles
+    :param right: right bounds of the rectangles
+    :return: array of the sums of the rectangles
+    """
+    return (int_img[bottom, right].astype(np.int64) - int_img[top, right]
+            - int_img[bottom, left] + int_img[top, left])
@@ -0,0 +1,205 @@
+import json
+import sqlite3
+import uuid
+from threading import Condition, Lock
+from time import time
+
+# Storage
+JOB_DB = 'jobs.sqlite'
+
+# Attempts
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 2.0       # seconds before the first retry of a job, doubled with every further attempt
+
+# Lifetime
+JOB_RESULT_TTL = 24 * 3600  # seconds a finished job, its result and its idempotency key are kept
+JOB_EXPIRE_INTERVAL = 60    # seconds between two sweeps of the expired jobs
+JOB_QUEUE_MAX = 10000       # jobs allowed to wait before submissions are turned away
+
+# Statuses
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+##
+# Durable queue of scan jobs, so that a photo is accepted at once and scanned when a worker is free. Jobs are kept in
+# an SQLite file: those queued or running when the server stops are scanned after it restarts.
+##
+
+
+class JobQueue:
+    """
+    Queue of scan jobs, each an encoded photo or the url of one with its scan parameters, and their results.
+    A job submitted again with the same idempotency key is not queued again; the job first submitted is returned.
+    A job whose attempt failed transiently, e.g. its photo could not be downloaded or its scan timed out, is queued
+    again after a delay, up to `max_attempts` attempts in all; any other failure is final. Finished jobs are deleted
+    `result_ttl` seconds after they finished.
+    Safe to share between threads.
+    """
+    def __init__(self, db_path=JOB_DB, max_attempts=JOB_MAX_ATTEMPTS, retry_delay=JOB_RETRY_DELAY,
+                 result_ttl=JOB_RESULT_TTL, max_queued=JOB_QUEUE_MAX):
+        """
+        :param db_path: path of the SQLite database file, ':memory:' for a queue that does not survive restarts
+        :param max_attempts: number of times a job is tried before it fails
+        :param retry_delay: seconds before the first retry of a job, doubled with every further attempt
+        :param result_ttl: seconds a finished job is kept
+        :param max_queued: number of jobs allowed to wait; further submissions are turned away
+        """
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.result_ttl = result_ttl
+        self.max_queued = max_queued
+        self.lock = Lock()
+        self.ready = Condition(self.lock)
+        self.last_expiry = 0
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                        'id TEXT PRIMARY KEY, idempotency_key TEXT UNIQUE, status TEXT NOT NULL, '
+                        'attempts INTEGER NOT NULL DEFAULT 0, image BLOB, url TEXT, params TEXT NOT NULL, '
+                        'result TEXT, error TEXT, created REAL NOT NULL, not_before REAL NOT NULL, expires REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, not_before)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_expires ON jobs (expires)')
+        # Jobs left running by a server that stopped are tried again, their attempt counted, so that a photo that
+        # brings the server down is not tried forever
+        self.db.execute('UPDATE jobs SET status = ?, error = ?, image = NULL, expires = ? '
+                        'WHERE status = ? AND attempts >= ?',
+                        (FAILED, 'server stopped while scanning', time() + result_ttl, RUNNING, max_attempts))
+        self.db.execute('UPDATE jobs SET status = ? WHERE status = ?', (QUEUED, RUNNING))
+        self.db.commit()
+
+    def submit(self, params, image=None, url=None, idempotency_key=None):
+        """
+        Queues a job.
+        :param params: dictionary of the scan parameters, e.g. `num_papers` and `num_questions`
+        :param image: encoded photo, or None to download it from `url`
+        :param url: url of the photo, if `image` is None
+        :param idempotency_key: key chosen by the client to identify the job, so that submitting it again when the
+                                response was lost does not scan it again; None to always queue
+        :return: (job id, whether the job was queued by this call) as a tuple, or None if the queue is full
+        """
+        now = time()
+        with self.lock:
+            if idempotency_key is not None:
+                # an expired job the sweep has not deleted yet does not hold its key any more
+                self.db.execute('DELETE FROM jobs WHERE idempotency_key = ? AND expires <= ?', (idempotency_key, now))
+                row = self.db.execute('SELECT id FROM jobs WHERE idempotency_key = ?', (idempotency_key,)).fetchone()
+                if row is not None:
+                    return str(row[0]), False
+            queued = self.db.execute('SELECT COUNT(*) FROM jobs WHERE status = ?', (QUEUED,)).fetchone()[0]
+            if queued >= self.max_queued:
+                return None
+            job_id = uuid.uuid4().hex
+            self.db.execute('INSERT INTO jobs (id, idempotency_key, status, image, url, params, created, not_before) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                            (job_id, idempotency_key, QUEUED, sqlite3.Binary(image) if image is not None else None,
+                             url, json.dumps(params), now, now))
+            self.db.commit()
+            self.ready.notify()
+        return job_id, True
+
+    def claim(self, timeout=None):
+        """
+        Takes the oldest job due, waiting for one if there is none, and marks it running.
+        :param timeout: seconds to wait for a job, None to wait until one is due
+        :return: (job id, parameters dictionary, encoded photo or None, url or None) as a tuple, or None if no job
+                 became due in time
+        """
+        deadline = time() + timeout if timeout is not None else None
+        with self.lock:
+            while True:
+                now = time()
+                if now - self.last_expiry >= JOB_EXPIRE_INTERVAL:
+                    self.delete_expired(now)
+                row = self.db.execute('SELECT id, params, image, url FROM jobs WHERE status = ? AND not_before <= ? '
+                                      'ORDER BY not_before LIMIT 1', (QUEUED, now)).fetchone()
+                if row is not None:
+                    self.db.execute('UPDATE jobs SET status = ?, attempts = attempts + 1 WHERE id = ?',
+                                    (RUNNING, row[0]))
+                    self.db.commit()
+                    return str(row[0]), json.loads(row[1]), str(row[2]) if row[2] is not None else None, row[3]
+                # Sleep until the next retry is due, a job is submitted or the timeout is over
+                wait = [deadline - now] if deadline is not None else []
+                row = self.db.execute('SELECT MIN(not_before) FROM jobs WHERE status = ?', (QUEUED,)).fetchone()
+                if row[0] is not None:
+                    wait.append(row[0] - now)
+                if deadline is not None and now >= deadline:
+                    return None
+                self.ready.wait(max(0.0, min(wait)) if wait else None)
+
+    def complete(self, job_id, res):
+        """
+        Stores the result of a job, and drops its photo.
+        :param job_id: id returned by claim()
+        :param res: JSON string of the result
+        """
+        now = time()
+        with self.lock:
+            self.db.execute('UPDATE jobs SET status = ?, result = ?, error = NULL, image = NULL, expires = ? '
+                            'WHERE id = ?', (DONE, res, now + self.result_ttl, job_id))
+            self.db.commit()
+
+    def fail(self, job_id, error, transient=False):
+        """
+        Records the failure of an attempt at a job.
+        :param job_id: id returned by claim()
+        :param error: reason of the failure
+        :param transient: whether the job may succeed if tried again
+        :return: True if the job was queued again, False if it failed for good
+        """
+        now = time()
+        with self.lock:
+            attempts = self.db.execute('SELECT attempts FROM jobs WHERE id = ?', (job_id,)).fetchone()[0]
+            if transient and attempts < self.max_attempts:
+                self.db.execute('UPDATE jobs SET status = ?, error = ?, not_before = ? WHERE id = ?',
+                                (QUEUED, error, now + self.retry_delay * 2 ** (attempts - 1), job_id))
+                self.ready.notify()
+                retried = True
+            else:
+                self.db.execute('UPDATE jobs SET status = ?, error = ?, image = NULL, expires = ? WHERE id = ?',
+                                (FAILED, error, now + self.result_ttl, job_id))
+                retried = False
+            self.db.commit()
+        return retried
+
+    def get(self, job_id):
+        """
+        Looks up a job.
+        :param job_id: id returned by submit()
+        :return: dictionary of the `job_id`, `status`, `attempts` and, once known, the JSON string of the `result` or
+                 the `error` of the job, or None if there is no such job or it expired
+        """
+        with self.lock:
+            row = self.db.execute('SELECT status, attempts, result, error, expires FROM jobs WHERE id = ?',
+                                  (job_id,)).fetchone()
+        if row is None or row[4] is not None and row[4] <= time():
+            return None
+        job = {'job_id': job_id, 'status': str(row[0]), 'attempts': row[1]}
+        if row[2] is not None:
+            job['result'] = str(row[2])
+        if row[3] is not None:
+            job['error'] = row[3]
+        return job
+
+    def delete_expired(self, now):
+        """
+        Deletes the jobs that finished more than `result_ttl` seconds ago, freeing their idempotency keys.
+        Must be called with the lock held.
+        """
+        self.db.execute('DELETE FROM jobs WHERE expires <= ?', (now,))
+        self.db.commit()
+        self.last_expiry = now
+
+    def stats(self):
+        """
+        :return: dictionary of the number of jobs of each status
+        """
+        with self.lock:
+            rows = self.db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        counts = dict.fromkeys([QUEUED, RUNNING, DONE, FAILED], 0)
+        counts.update((str(status), n) for status, n in rows)
+        return counts
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+import numpy as np
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+DEFAULT_TEMPLATE = 'standard60'
+
+# compiled layouts by template id, shared by all papers of the same format
+layouts = {}
+
+
+class SheetLayout:
+    """
+    Geometry of one bubble sheet format, loaded from a JSON template file.
+    Everything that does not depend on the photo is compiled once into arrays, so that each paper only has to add its
+    own trimmed offsets to them.
+    """
+    template_id = None
+    digest = None
+    paper_size = None
+    template_key_pts = None
+    datamatrix_region = None
+    option_labels = None
+    num_options = 0
+    option_margin = 0
+    vertical_scan_range = None
+    num_fields = 0
+    field_boxes = None
+    table_region = None
+    option_steps = None
+
+    def __init__(self, template_id, spec):
+        """
+        Compiles a layout.
+        :param template_id: id the layout is cached by
+        :param spec: dictionary loaded from the template file
+        """
+        self.template_id = template_id
+        self.digest = hashlib.sha1(json.dumps(spec, sort_keys=True)).hexdigest()
+        self.paper_size = tuple(spec['paper_size'])
+        self.template_key_pts = np.float32(spec['template_key_pts'])
+        self.datamatrix_region = tuple(spec['datamatrix_region'])
+        self.option_labels = list(spec['option_labels'])
+        self.num_options = len(self.option_labels)
+        self.option_margin = spec['option_margin']
+        self.vertical_scan_range = np.array(spec['vertical_scan_range'])
+        self.option_steps = np.arange(self.num_options + 1)
+
+        # Answer fields run down each column, then on to the next column. Fields start on the exact row pitch but end
+        # on the integer one, as they always have.
+        num_rows = spec['num_rows']
+        row_start, row_end = spec['row_range']
+        offset = spec['segment_offset']
+        boxes = []
+        for left, right in spec['col_end_pts']:
+            for row in range(num_rows):
+                up = int(row_start + row * ((row_end - row_start) / (num_rows * 1.0))) - offset
+                down = int(row_start + (row + 1) * ((row_end - row_start) // num_rows)) + offset
+                boxes.append((up, down, left - offset, right + offset))
+        self.num_fields = len(boxes)
+        self.field_boxes = np.array(boxes, dtype=int)
+        self.field_boxes.setflags(write=False)
+        # region of the paper covering all answer fields, the only part of the paper besides the datamatrix to be read
+        self.table_region = (max(0, int(self.field_boxes[:, 0].min())), int(self.field_boxes[:, 1].max()),
+                             max(0, int(self.field_boxes[:, 2].min())), int(self.field_boxes[:, 3].max()))
+
+
+def load_layout(template=DEFAULT_TEMPLATE):
+    """
+    Gets the compiled layout of a sheet format, loading and compiling its template file on first use.
+    :param template: template id, naming a file in TEMPLATE_DIR without extension, or a path to a template file
+    :return: SheetLayout object
+    """
+    if template not in layouts:
+        path = template if template.endswith('.json') else os.path.join(TEMPLATE_DIR, template + '.json')
+        with open(path) as f:
+            layouts[template] = SheetLayout(template, json.load(f))
+    return layouts[template]
@@ -1,117 +1,251 @@
 import cv2
-import json
+import os
+import numpy as np
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+from time import time
 
-import sys
 from pylibdmtx.pylibdmtx import decode
+from integral import rect_sums
+from layout import load_layout
+from scan_result import ScanResult, encode_answers
+from instrument import stage, count
 from options import DEBUG
 
 # Adaptive threshold
 THR_MAX_VAL = 255
 THR_BLOCK_SIZE = 29
 THR_OFFSET = 8
+THR_ALTERNATES = [(21, 6), (41, 10)]    # (block size, offset) pairs uncertain answers are trimmed again with
 
 # Datamatrix
-READ_DATAMATRIX_TIMEOUT = 3
-DATAMATRIX_REGION = (40, 140, 740, 840)
+# Timeouts are in milliseconds, as decode() takes them
+READ_DATAMATRIX_TIMEOUT = 3     # most time one decoding attempt of a paper may take
+DATAMATRIX_BUDGET = 8           # time all decoding attempts of a paper may take together
+DATAMATRIX_MIN_TIMEOUT = 1      # least time an attempt is given while some budget is left
 DATAMATRIX_SPLIT = 5
+DATAMATRIX_RESCALE = 2
+DATAMATRIX_WORKERS = 4
 
-# Paper segmentation
-NUM_ROWS = 15
-NUM_COLS = 4
-MAX_NUM_QUESTIONS = NUM_ROWS * NUM_COLS
-SEGMENT_OFFSET = 12
-COL_END_PTS = [[87, 227], [266, 406], [446, 586], [624, 764]]
-ROW_RANGE = (306, 1126)
+# Paper segmentation (the geometry of each sheet format is in its layout)
+MAX_NUM_QUESTIONS = load_layout().num_fields
 TRIM_ROWS_TO_SCAN = 22
 TRIM_THRESHOLD = 0.5
 
 # Answer scanning
-NUM_OPTIONS = 5
-LEFT_RIGHT_MARGIN = 7
-VERTICAL_SCAN_RANGE = [7, 30]
-IDX_TO_LETTER = ['A', 'B', 'C', 'D', 'E']
 NORMALIZE_SCAN_RANGE_X = [0, 0.5]
 NORMALIZE_SCAN_RANGE_Y = [0, 1]
 NORMALIZE_TAIL_PROPORTION = 0.01
 GAP_THRESHOLD = 0.74
 
+# Answer confidence
+CONFIDENCE_THRESHOLD = 0.1  # gap between the darkest and the second darkest option, relative to the span between the
+                            # black and white references of the block, below which an answer is read again
+MARK_CONTRAST = 0.15        # gap to the brightest option, relative to the same span, above which an option is marked
+                            # when uncertain answers are read allowing multiple selections
+
+
+def threshold_region(raw_img, region, block_size=THR_BLOCK_SIZE, offset=THR_OFFSET):
+    """
+    Thresholds one region of an image. The region is thresholded together with a margin of half a block around it, so
+    that every pixel of it comes out exactly as if the whole image had been thresholded.
+    :param raw_img: raw image
+    :param region: (up, down, left, right) bounds of the region
+    :param block_size: size of the neighborhood of the adaptive threshold
+    :param offset: constant subtracted from the weighted mean of the neighborhood
+    :return: binary image of the region
+    """
+    h, w = raw_img.shape[:2]
+    up, down, left, right = region
+    margin = block_size // 2
+    y0, y1 = max(0, up - margin), min(h, down + margin)
+    x0, x1 = max(0, left - margin), min(w, right + margin)
+    thr_img = cv2.adaptiveThreshold(raw_img[y0:y1, x0:x1], THR_MAX_VAL, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                    cv2.THRESH_BINARY_INV, block_size, offset)
+    return thr_img[up - y0:down - y0, left - x0:right - x0]
+
+
+def threshold_table(raw_img, layout, block_size=THR_BLOCK_SIZE, offset=THR_OFFSET):
+    """
+    Thresholds the answer table of a paper, the only region of the paper the answers are read from.
+    :param raw_img: raw paper image
+    :param layout: SheetLayout of the paper
+    :return: binary image of the answer table only, whose top left corner is at (up, left) of layout.table_region
+    """
+    return threshold_region(raw_img, layout.table_region, block_size, offset)
+
 
 def remove_edges(ans_img_raw, ans_img_thr):
     """
     Trims the edges of each block by traversing lines inverse until we _hit and pass_ a black line.
-    Four sides are rather repetitive and could be refactored.
     :param ans_img_raw: raw image of the answer block
     :param ans_img_thr: binary image of the answer block
     :return: trimmed image of the answer block, raw and binary (we need the raw picture for reading the answers)
     """
     h, w = ans_img_thr.shape[:2]
+    t, b, l, r = trim_offsets(ans_img_thr, np.array([[0, h, 0, w]]))[0]
+    return ans_img_raw[t:h - b, l:w - r], ans_img_thr[t:h - b, l:w - r]
 
-    # Top
-    t = 0
-    flag = False
-    for t in range(TRIM_ROWS_TO_SCAN):
-        if sum(ans_img_thr[t]) > TRIM_THRESHOLD * w * 255:
-            flag = True
-        else:
-            if flag:
-                break
-    if t == TRIM_ROWS_TO_SCAN - 1:
-        t = 0
-
-    # Bottom
-    b = 0
-    flag = False
-    for b in range(TRIM_ROWS_TO_SCAN):
-        if sum(ans_img_thr[- (b + 1)]) > TRIM_THRESHOLD * w * 255:
-            flag = True
-        else:
-            if flag:
-                break
-    if b == TRIM_ROWS_TO_SCAN - 1:
-        b = 0
-
-    # Left
-    l = 0
-    flag = False
-    for l in range(TRIM_ROWS_TO_SCAN):
-        if sum(ans_img_thr[:, l]) > TRIM_THRESHOLD * h * 255:
-            flag = True
-        else:
-            if flag:
-                break
-    if l == TRIM_ROWS_TO_SCAN - 1:
-        l = 0
-
-    # Right
-    r = 0
-    flag = False
-    for r in range(TRIM_ROWS_TO_SCAN):
-        if sum(ans_img_thr[:, - (r + 1)]) > TRIM_THRESHOLD * h * 255:
-            flag = True
-        else:
-            if flag:
-                break
-    if r == TRIM_ROWS_TO_SCAN - 1:
-        r = 0
 
-    return ans_img_raw[t:h - b, l:w - r], ans_img_thr[t:h - b, l:w - r]
+def trim_offsets(thr_img, boxes):
+    """
+    Finds the number of rows and columns to trim off each side of many answer blocks at once.
+    The ink profiles of the outer TRIM_ROWS_TO_SCAN lines on each side of every block are read from a single integral
+    image of the binary region covering all blocks, then each side is traversed inwards until we _hit and pass_ a
+    black line.
+    :param thr_img: binary image containing the answer blocks
+    :param boxes: (n, 4) array of the answer blocks as (up, down, left, right)
+    :return: (n, 4) array of the (top, bottom, left, right) offsets of each block
+    """
+    y0, x0 = boxes[:, 0].min(), boxes[:, 2].min()
+    int_img = cv2.integral(thr_img[y0:boxes[:, 1].max(), x0:boxes[:, 3].max()])
+    up, down, left, right = [(boxes[:, k] - base)[:, np.newaxis] for k, base in enumerate((y0, y0, x0, x0))]
+    lines = np.arange(TRIM_ROWS_TO_SCAN)
+    row_threshold = TRIM_THRESHOLD * (right - left) * 255
+    col_threshold = TRIM_THRESHOLD * (down - up) * 255
+
+    top = rect_sums(int_img, up + lines, up + lines + 1, left, right) > row_threshold
+    bottom = rect_sums(int_img, down - lines - 1, down - lines, left, right) > row_threshold
+    left_side = rect_sums(int_img, up, down, left + lines, left + lines + 1) > col_threshold
+    right_side = rect_sums(int_img, up, down, right - lines - 1, right - lines) > col_threshold
+    return np.stack([passed_line(ink) for ink in (top, bottom, left_side, right_side)], axis=1)
+
+
+def passed_line(ink):
+    """
+    Finds the first line without ink that comes after a line with ink, for many blocks at once.
+    Scanning the full range without passing a line, or passing it only on the last scanned line, gives 0.
+    :param ink: (n, TRIM_ROWS_TO_SCAN) boolean array telling whether each scanned line, outermost first, is inked
+    :return: (n,) array of line indices
+    """
+    seen = np.logical_or.accumulate(ink, axis=1)
+    passed = ~ink[:, 1:] & seen[:, :-1]
+    idx = np.argmax(passed, axis=1) + 1
+    return np.where(passed.any(axis=1) & (idx != TRIM_ROWS_TO_SCAN - 1), idx, 0)
+
+
+def option_windows(layout, boxes, offsets):
+    """
+    Locates the scanned window of every option of every answer block, in the coordinates of the paper.
+    :param layout: SheetLayout of the paper
+    :param boxes: (n, 4) array of the untrimmed answer blocks as (up, down, left, right)
+    :param offsets: (n, 4) array of the trimmed offsets of the answer blocks as (top, bottom, left, right)
+    :return: (rows, cols), where rows is an (n, 2) array of the vertical scan range of each block and cols is an
+             (n, num_options + 1) array of the boundary points between its options
+    """
+    top = boxes[:, 0] + offsets[:, 0]
+    left = boxes[:, 2] + offsets[:, 2]
+    width = boxes[:, 3] - boxes[:, 2] - offsets[:, 2] - offsets[:, 3]
+    block_width = (width - 2 * layout.option_margin) // layout.num_options
+    rows = top[:, np.newaxis] + layout.vertical_scan_range
+    cols = (left + layout.option_margin)[:, np.newaxis] + block_width[:, np.newaxis] * layout.option_steps
+    return rows, cols
 
 
 def max_and_min(img):
     """
     Finds the 3% percentiles of the brightest and darkest point in a picture
+    Only the two percentiles are put in place, rather than sorting all points.
     :param img: picture to check
     :return: (max, min) as a tuple
     """
-    brightness = []
     h, w = img.shape[:2]
-    for i in range(int(h * NORMALIZE_SCAN_RANGE_X[0]), int(h * NORMALIZE_SCAN_RANGE_X[1])):
-        for j in range(int(w * NORMALIZE_SCAN_RANGE_Y[0]), int(w * NORMALIZE_SCAN_RANGE_Y[1])):
-            brightness.append(img[i, j])
-    brightness.sort()
-    max_ref = brightness[int(len(brightness) * (1 - NORMALIZE_TAIL_PROPORTION))]
-    min_ref = brightness[int(len(brightness) * NORMALIZE_TAIL_PROPORTION)]
-    return max_ref, min_ref
+    brightness = img[int(h * NORMALIZE_SCAN_RANGE_X[0]):int(h * NORMALIZE_SCAN_RANGE_X[1]),
+                     int(w * NORMALIZE_SCAN_RANGE_Y[0]):int(w * NORMALIZE_SCAN_RANGE_Y[1])].ravel()
+    max_idx = int(len(brightness) * (1 - NORMALIZE_TAIL_PROPORTION))
+    min_idx = int(len(brightness) * NORMALIZE_TAIL_PROPORTION)
+    brightness = np.partition(brightness, (min_idx, max_idx))
+    return brightness[max_idx], brightness[min_idx]
+
+
+def block_refs(raw_img, boxes):
+    """
+    Finds the white and black references of many answer blocks at once, as max_and_min() does for one.
+    The scanned pixels of each block are counted into a histogram rather than sorted, and both percentiles of all blocks
+    are looked up in their cumulative histograms together.
+    :param raw_img: raw paper image
+    :param boxes: (n, 4) array of the answer blocks as (up, down, left, right)
+    :return: (n, 2) array of the (max, min) references of each block
+    """
+    if not len(boxes):
+        return np.zeros((0, 2))
+    histograms = []
+    for up, down, left, right in boxes:
+        h, w = down - up, right - left
+        block = raw_img[up + int(h * NORMALIZE_SCAN_RANGE_X[0]):up + int(h * NORMALIZE_SCAN_RANGE_X[1]),
+                        left + int(w * NORMALIZE_SCAN_RANGE_Y[0]):left + int(w * NORMALIZE_SCAN_RANGE_Y[1])]
+        histograms.append(cv2.calcHist([block], [0], None, [256], [0, 256]).ravel())
+    cumulative = np.cumsum(histograms, axis=1)
+    sizes = cumulative[:, -1].astype(int)
+    # the k-th smallest pixel is the first value counting more than k pixels up to it
+    max_idx = (sizes * (1 - NORMALIZE_TAIL_PROPORTION)).astype(int)
+    min_idx = (sizes * NORMALIZE_TAIL_PROPORTION).astype(int)
+    return np.stack([(cumulative <= max_idx[:, np.newaxis]).sum(axis=1),
+                     (cumulative <= min_idx[:, np.newaxis]).sum(axis=1)], axis=1).astype(np.float64)
+
+
+def answer_confidence(brightness, refs):
+    """
+    Measures how clearly the darkest option of each answer block stands out: the gap between its brightness and the
+    brightness of the second darkest option, relative to the span between the white and black references of the block.
+    :param brightness: (n, num_options) array of the mean brightness of every option of every block
+    :param refs: (n, 2) array of the (max, min) references of each block, as block_refs() returns
+    :return: (n,) array of confidences between 0 and 1
+    """
+    darkest = np.partition(brightness, 1, axis=1)
+    span = np.maximum(refs[:, 0] - refs[:, 1], 1.0)
+    return np.clip((darkest[:, 1] - darkest[:, 0]) / span, 0.0, 1.0)
+
+
+# thread pools decoding datamatrices in the background, by process id so that forked workers start their own
+datamatrix_pools = {}
+datamatrix_pools_lock = Lock()
+datamatrix_stats = {'raw': 0, 'thresholded': 0, 'rescaled': 0, 'failed': 0}
+datamatrix_stats_lock = Lock()
+
+
+def datamatrix_pool():
+    """
+    Gets the thread pool of this process that decodes datamatrices.
+    :return: ThreadPool object
+    """
+    pid = os.getpid()
+    with datamatrix_pools_lock:
+        if pid not in datamatrix_pools:
+            datamatrix_pools[pid] = ThreadPool(DATAMATRIX_WORKERS)
+        return datamatrix_pools[pid]
+
+
+def decode_datamatrix(raw_img, region):
+    """
+    Decodes the datamatrix on a paper, trying the cheapest crops first: the raw crop, then the crop thresholded on its
+    own, then the raw crop enlarged by DATAMATRIX_RESCALE. The attempts share the DATAMATRIX_BUDGET budget, each
+    getting at most READ_DATAMATRIX_TIMEOUT of what is left, so that a raw crop failing slowly still leaves the binary
+    crop its full time; the attempt that succeeds is counted in datamatrix_stats.
+    :param raw_img: raw paper image
+    :param region: (up, down, left, right) bounds of the datamatrix on the paper
+    :return: (content, rung) as a tuple, where rung names the crop that was decoded; both are None if none was
+    """
+    bounds = region
+    region = (slice(region[0], region[1]), slice(region[2], region[3]))
+    rungs = [('raw', lambda: raw_img[region]),
+             ('thresholded', lambda: threshold_region(raw_img, bounds)),
+             ('rescaled', lambda: cv2.resize(raw_img[region], None, fx=DATAMATRIX_RESCALE, fy=DATAMATRIX_RESCALE,
+                                             interpolation=cv2.INTER_CUBIC))]
+    deadline = time() + DATAMATRIX_BUDGET / 1000.0
+    content, rung = None, None
+    for name, crop in rungs:
+        remaining = int((deadline - time()) * 1000)
+        if remaining <= 0:
+            break
+        timeout = max(DATAMATRIX_MIN_TIMEOUT, min(READ_DATAMATRIX_TIMEOUT, remaining))
+        decoded = decode(crop(), timeout=timeout, max_count=1)
+        if decoded:
+            content, rung = decoded[0][0], name
+            break
+    with datamatrix_stats_lock:
+        datamatrix_stats[rung or 'failed'] += 1
+    return content, rung
 
 
 class PaperScan:
@@ -120,43 +254,71 @@ class PaperScan:
     """
     raw_img = None
     thr_img = None
+    int_img = None
+    layout = None
     test_id = None
     paper_id = None
     num_questions = 0
-    ans_imgs_raw = [None] * MAX_NUM_QUESTIONS
-    ans_imgs_thr = [None] * MAX_NUM_QUESTIONS
-    marked_ans = [0] * MAX_NUM_QUESTIONS
+    ans_imgs_raw = None
+    ans_imgs_thr = None
+    ans_boxes = None
+    marked_ans = None
+    confidence = None
     metadata = ''
-    json_res = None
+    datamatrix_rung = None
+    result = None
 
-    def __init__(self, raw_img, num_questions=MAX_NUM_QUESTIONS):
+    def __init__(self, raw_img, num_questions=MAX_NUM_QUESTIONS, layout=None, rewarp=None):
         """
         Initializes and processes the paper. This is the only top-level function that needs to be called.
         Called only by its parent RawPhoto object.
         :param raw_img: raw paper image
         :param num_questions: number of questions in the paper
+        :param layout: SheetLayout of the paper, the default sheet format if None
+        :param rewarp: function without arguments warping the paper out of the photo again more precisely, returning the
+                       raw paper image or None; only called if some answers are still uncertain after trimming again
         """
         self.raw_img = raw_img
         self.num_questions = num_questions
-        self.thr_img = cv2.adaptiveThreshold(self.raw_img, THR_MAX_VAL, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                             cv2.THRESH_BINARY_INV, THR_BLOCK_SIZE, THR_OFFSET)
-        self.read_datamatrix()
-        self.segment()
-        self.read_all_answers_single()
-        data_dict = {'test_id': self.test_id,
-                     'paper_id': self.paper_id,
-                     'answers': self.marked_ans,
-                     'metadata': self.metadata}
-        self.json_res = json.dumps(data_dict)
-
-    def read_datamatrix(self):
+        self.layout = layout or load_layout()
+        self.ans_imgs_raw = [None] * self.layout.num_fields
+        self.ans_imgs_thr = [None] * self.layout.num_fields
+        self.ans_boxes = self.layout.field_boxes
+        self.marked_ans = [0] * self.layout.num_fields
+        self.confidence = np.zeros(self.layout.num_fields, np.float32)
+        self.metadata = ''
+        # Decode the datamatrix in the background while the answers are read
+        decoding = datamatrix_pool().apply_async(decode_datamatrix, (self.raw_img, self.layout.datamatrix_region))
+        with stage('paper_threshold'):
+            self.threshold_table()
+        with stage('segment'):
+            self.segment()
+        with stage('read_answers'):
+            self.read_all_answers_single()
+        if len(self.uncertain_questions()):
+            with stage('recover'):
+                self.recover(rewarp)
+        with stage('read_datamatrix'):
+            self.read_datamatrix(decoding)
+        count('papers')
+        count('datamatrix_%s' % (self.datamatrix_rung or 'failed'))
+        # the integral image is only needed while reading
+        self.int_img = None
+        self.result = ScanResult(self.test_id, self.paper_id,
+                                 encode_answers(self.marked_ans, self.layout.option_labels),
+                                 self.num_questions, self.layout.option_labels, self.metadata,
+                                 self.confidence)
+
+    def read_datamatrix(self, decoding=None):
         """
         Reads the content datamatrix on the paper.
+        :param decoding: AsyncResult of decode_datamatrix() already running for this paper; decodes here if None
         """
-        datamatrix_region = self.thr_img[DATAMATRIX_REGION[0]:DATAMATRIX_REGION[1],
-                                         DATAMATRIX_REGION[2]:DATAMATRIX_REGION[3]]
         try:
-            content = decode(datamatrix_region, timeout=READ_DATAMATRIX_TIMEOUT)[0][0]
+            if decoding is None:
+                content, self.datamatrix_rung = decode_datamatrix(self.raw_img, self.layout.datamatrix_region)
+            else:
+                content, self.datamatrix_rung = decoding.get()
             self.test_id = content[:DATAMATRIX_SPLIT]
             self.paper_id = content[DATAMATRIX_SPLIT:]
         except:
@@ -166,21 +328,53 @@ class PaperScan:
         if DEBUG:
             print('Test id: %s\tPaper id: %s' % (self.test_id, self.paper_id))
 
+    def threshold_table(self):
+        """
+        Thresholds the answer table, the only region of the paper the answers are read from. Only the table is kept in
+        thr_img; table_boxes() locates regions of the paper on it.
+        """
+        self.thr_img = threshold_table(self.raw_img, self.layout)
+
+    def table_boxes(self, boxes):
+        """
+        :param boxes: (n, 4) array of regions of the paper as (up, down, left, right)
+        :return: array of the same regions on thr_img, or on any other binary image of the answer table
+        """
+        up, _, left, _ = self.layout.table_region
+        return boxes - [up, up, left, left]
+
     def segment(self):
         """
         Segment the image into pieces of answer blocks
         """
-        for i in range(MAX_NUM_QUESTIONS):
-            col = int(i / NUM_ROWS)
-            row = i % NUM_ROWS
-            up = int(ROW_RANGE[0] + row * ((ROW_RANGE[1] - ROW_RANGE[0]) / (NUM_ROWS * 1.0))) - SEGMENT_OFFSET
-            down = int(ROW_RANGE[0] + (row + 1) * ((ROW_RANGE[1] - ROW_RANGE[0]) / NUM_ROWS)) + SEGMENT_OFFSET
-            left = COL_END_PTS[col][0] - SEGMENT_OFFSET
-            right = COL_END_PTS[col][1] + SEGMENT_OFFSET
-            ans_img_thr = self.thr_img[up:down, left:right]
-            ans_img_raw = self.raw_img[up:down, left:right]
-            self.ans_imgs_thr[i] = ans_img_thr
-            self.ans_imgs_raw[i] = ans_img_raw
+        for i, (up, down, left, right) in enumerate(self.table_boxes(self.ans_boxes)):
+            self.ans_imgs_thr[i] = self.thr_img[up:down, left:right]
+        for i, (up, down, left, right) in enumerate(self.ans_boxes):
+            self.ans_imgs_raw[i] = self.raw_img[up:down, left:right]
+
+    def option_sums(self, questions=None, thr_img=None, int_img=None):
+        """
+        Sums the brightness of every option of every answer block in a few array operations.
+        The answer blocks are trimmed first, then all scanned windows are looked up in an integral image of the raw
+        paper at once.
+        :param questions: array of the indices of the questions to sum, all questions asked if None
+        :param thr_img: binary image of the answer table the blocks are trimmed on, thr_img if None
+        :param int_img: integral image of the raw paper the options are summed on, that of raw_img if None
+        :return: (sums, num_pts), where sums is a (num_questions, num_options) array of brightness sums and num_pts is a
+                 (num_questions, 1) array of the number of pixels summed for each option of each block
+        """
+        if int_img is None:
+            if self.int_img is None:
+                self.int_img = cv2.integral(self.raw_img)
+            int_img = self.int_img
+        if thr_img is None:
+            thr_img = self.thr_img
+        boxes = self.ans_boxes[:self.num_questions] if questions is None else self.ans_boxes[questions]
+        offsets = trim_offsets(thr_img, self.table_boxes(boxes)) if len(boxes) else boxes
+        rows, cols = option_windows(self.layout, boxes, offsets)
+        sums = rect_sums(int_img, rows[:, :1], rows[:, 1:], cols[:, :-1], cols[:, 1:])
+        num_pts = (rows[:, 1:] - rows[:, :1]) * (cols[:, 1:2] - cols[:, :1])
+        return sums, num_pts
 
     def read_all_answers_single(self):
         """
@@ -189,30 +383,84 @@ class PaperScan:
         Read from the raw image because Gaussian Adaptive Threshold treats any large block of content, either dark or
         bright, as background. Therefore, only the edges of the circles is detected. We need the inside content of the
         circle for accuracy.
+        How clearly each selection stands out is kept in confidence.
         """
-        for i in range(self.num_questions):
-            raw_img = self.ans_imgs_raw[i]
-            thr_img = self.ans_imgs_thr[i]
-            img, _ = remove_edges(raw_img, thr_img)
-            img_height, img_width = img.shape[:2]
-
-            # Cut region into NUM_OPTIONS pieces
-            img_height, img_width = img.shape[:2]
-            block_width = int((img_width - 2 * LEFT_RIGHT_MARGIN) / NUM_OPTIONS)
-            boundary_pts = [LEFT_RIGHT_MARGIN] + [0] * NUM_OPTIONS
-            for j in range(NUM_OPTIONS):
-                boundary_pts[j + 1] = boundary_pts[0] + (j + 1) * block_width
-
-            # Count brightness
-            lowest_val, lowest_idx = sys.maxint, 0
-            for j in range(NUM_OPTIONS):
-                this_brightness = 0
-                for x in range(VERTICAL_SCAN_RANGE[0], VERTICAL_SCAN_RANGE[1]):
-                    for y in range(boundary_pts[j], boundary_pts[j + 1]):
-                        this_brightness += img[x, y]
-                if this_brightness < lowest_val:
-                    lowest_val, lowest_idx = this_brightness, j
-            self.marked_ans[i] = IDX_TO_LETTER[lowest_idx]
+        sums, num_pts = self.option_sums()
+        for i, lowest_idx in enumerate(np.argmin(sums, axis=1)):
+            self.marked_ans[i] = self.layout.option_labels[lowest_idx]
+        refs = block_refs(self.raw_img, self.ans_boxes[:self.num_questions])
+        self.confidence[:self.num_questions] = answer_confidence(sums / num_pts.astype(np.float64), refs)
+
+    def uncertain_questions(self):
+        """
+        :return: array of the indices of the questions whose answer has a confidence below CONFIDENCE_THRESHOLD
+        """
+        return np.flatnonzero(self.confidence[:self.num_questions] < CONFIDENCE_THRESHOLD)
+
+    def recover(self, rewarp=None):
+        """
+        Reads the uncertain answers again, the cheaper way first, as long as some are left: trimmed on the paper
+        thresholded with each of THR_ALTERNATES, then on the paper warped again. The answers still uncertain after that
+        are read allowing multiple selections, so that a question left blank or marked twice is reported as such rather
+        than as its darkest option.
+        :param rewarp: function warping the paper again, as PaperScan() takes it; None to skip that step
+        """
+        uncertain = self.uncertain_questions()
+        count('answers_uncertain', len(uncertain))
+        for block_size, offset in THR_ALTERNATES:
+            if not len(uncertain):
+                return
+            self.reread(uncertain, thr_img=threshold_table(self.raw_img, self.layout, block_size, offset))
+            count('recovered_threshold', len(uncertain) - len(self.uncertain_questions()))
+            uncertain = self.uncertain_questions()
+        if not len(uncertain):
+            return
+        raw_img = rewarp() if rewarp is not None else None
+        if raw_img is not None:
+            count('rewarps')
+            self.reread(uncertain, raw_img, threshold_table(raw_img, self.layout))
+            count('recovered_rewarp', len(uncertain) - len(self.uncertain_questions()))
+            uncertain = self.uncertain_questions()
+        if len(uncertain):
+            self.read_answers_multiple(uncertain)
+
+    def reread(self, questions, raw_img=None, thr_img=None):
+        """
+        Reads the selection of some answer blocks again, keeping the new reading of a block if it is more confident.
+        :param questions: array of the indices of the questions to read
+        :param raw_img: raw paper image to read from, raw_img if None
+        :param thr_img: binary image of the answer table of raw_img to trim the blocks on, thr_img if None
+        """
+        int_img = None
+        if raw_img is None:
+            raw_img = self.raw_img
+        else:
+            int_img = cv2.integral(raw_img)
+        sums, num_pts = self.option_sums(questions, thr_img, int_img)
+        refs = block_refs(raw_img, self.ans_boxes[questions])
+        confidence = answer_confidence(sums / num_pts.astype(np.float64), refs)
+        better = confidence > self.confidence[questions]
+        for i, lowest_idx in zip(questions[better], np.argmin(sums[better], axis=1)):
+            self.marked_ans[i] = self.layout.option_labels[lowest_idx]
+        self.confidence[questions[better]] = confidence[better]
+
+    def read_answers_multiple(self, questions):
+        """
+        Reads the selection of some answer blocks allowing multiple selections. Unlike raad_all_answers_multiple(), an
+        option is selected by how much darker it is than the brightest option of its block rather than by an absolute
+        level between the references, so that a blank block on a dull photo does not come out with every option
+        selected. Blocks with exactly one selection keep the answer they have, which is then the same.
+        :param questions: array of the indices of the questions to read
+        """
+        sums, num_pts = self.option_sums(questions)
+        brightness = sums / num_pts.astype(np.float64)
+        refs = block_refs(self.raw_img, self.ans_boxes[questions])
+        span = np.maximum(refs[:, 0] - refs[:, 1], 1.0)
+        selected = (brightness.max(axis=1)[:, np.newaxis] - brightness) / span[:, np.newaxis] > MARK_CONTRAST
+        for i, options in zip(questions, selected):
+            if options.sum() != 1:
+                self.marked_ans[i] = ''.join(label for label, s in zip(self.layout.option_labels, options) if s)
+                count('answers_blank' if not options.any() else 'answers_multiple')
 
     def raad_all_answers_multiple(self):
         """
@@ -222,42 +470,24 @@ class PaperScan:
         bright, as background. Therefore, only the edges of the circles is detected. We need the inside content of the
         circle for accuracy.
         """
+        sums, num_pts = self.option_sums()
+        brightness = sums // num_pts
         for i in range(self.num_questions):
-            raw_img = self.ans_imgs_raw[i]
-            thr_img = self.ans_imgs_thr[i]
-            max_ref, min_ref = max_and_min(raw_img)
+            max_ref, min_ref = max_and_min(self.ans_imgs_raw[i])
             if DEBUG:
                 print max_ref, min_ref
-            img, _ = remove_edges(raw_img, thr_img)
-            if DEBUG:
+                img, _ = remove_edges(self.ans_imgs_raw[i], self.ans_imgs_thr[i])
                 cv2.imwrite("tmp/ans-img-raw-%s-%s-%d.png" % (self.test_id, self.paper_id, i), img)
-
-            # Cut region into NUM_OPTIONS pieces
-            img_height, img_width = img.shape[:2]
-            block_width = int((img_width - 2 * LEFT_RIGHT_MARGIN) / NUM_OPTIONS)
-            boundary_pts = [LEFT_RIGHT_MARGIN] + [0] * NUM_OPTIONS
-            for j in range(NUM_OPTIONS):
-                boundary_pts[j + 1] = boundary_pts[0] + (j + 1) * block_width
-
-            # Count brightness
-            brightness = [0] * NUM_OPTIONS
-            temp = [0] * NUM_OPTIONS        # logs (this_brightness - black) / (white - black) values
-            for j in range(NUM_OPTIONS):
-                for x in range(VERTICAL_SCAN_RANGE[0], VERTICAL_SCAN_RANGE[1]):
-                    for y in range(boundary_pts[j], boundary_pts[j + 1]):
-                        brightness[j] += img[x, y]
-                num_pts = (VERTICAL_SCAN_RANGE[1] - VERTICAL_SCAN_RANGE[0]) * (boundary_pts[j + 1] - boundary_pts[j])
-                brightness[j] /= num_pts
-                temp[j] = '%.4f' % ((brightness[j] - min_ref) / float(max_ref - min_ref))
-            if DEBUG:
-                print brightness, temp
+                # logs (this_brightness - black) / (white - black) values
+                temp = ['%.4f' % ((val - min_ref) / float(max_ref - min_ref)) for val in brightness[i]]
+                print list(brightness[i]), temp
 
             # Select answers
             threshold = min_ref + (max_ref - min_ref) * GAP_THRESHOLD
             ans = ''
-            for j in range(NUM_OPTIONS):
-                if brightness[j] < threshold:
-                    ans += IDX_TO_LETTER[j]
+            for j in range(self.layout.num_options):
+                if brightness[i, j] < threshold:
+                    ans += self.layout.option_labels[j]
             self.marked_ans[i] = ans
             if DEBUG:
                 print('Test %s, Paper %s, Question %d: %s' % (self.test_id, self.paper_id, i + 1, ans))
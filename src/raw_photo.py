@@ -1,7 +1,17 @@
 import cv2
+import heapq
 import numpy as np
 import json
+import os
+from operator import itemgetter
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from threading import Lock
 from paper_scan import PaperScan, MAX_NUM_QUESTIONS
+from integral import rect_sums
+from layout import load_layout, DEFAULT_TEMPLATE
+from result_cache import image_key
+from instrument import stage, count, current, recording
 from options import DEBUG
 
 # Adaptive threshold
@@ -9,27 +19,211 @@ THR_MAX_VAL = 255
 THR_BLOCK_SIZE = 29
 THR_OFFSET = 8
 
+# Find tables
+APPROX_EPSILON = 4
+MIN_QUAD_AREA_RATIO = 0.01  # smallest table considered, relative to the photo; tables cover 10% or more of a photo
+DETECT_SIZE = None          # longest side of the downscaled photo tables are detected on, None for full resolution
+REFINE_MARGIN = 4           # margin around a coarse table searched again at full resolution, in downscaled pixels
+
 # Extract paper
 SIZE_VARIANCE_FACTOR = 0.7
-TEMPLATE_KEY_PTS = np.float32([[764, 307], [49, 307], [49, 1128], [764, 1128]])
-PAPER_SIZE = (875, 1240)
 REF_PT_RATIO = 1.053
 REF_PT_RANGE = 0.012
 
+# Scan papers
+PAPER_EXECUTOR = None       # 'thread' or 'process' to scan the papers of a photo concurrently, None to scan in turn
+PAPER_WORKERS = 4
+CROP_MARGIN = 2
+KEEP_IMAGES = DEBUG         # keep the PaperScan objects, with their images, in paper_objs
+
+# Warp papers again when their answers are uncertain
+CORNER_WINDOW = (5, 5)      # half of the side of the region around a table corner it is refined in, in pixels
+CORNER_MAX_ITER = 20
+CORNER_EPSILON = 0.01
+MIN_CORNER_SHIFT = 0.1      # smallest move of a refined corner worth warping the paper again for, in pixels
+
+
+def find_quads(thr_img, epsilon=APPROX_EPSILON, k=None):
+    """
+    Finds the largest convex quadrilaterals in a binary image.
+    Contours are first filtered by cheap checks of their number of points and bounding box, so that only those that
+    could be a table are approximated to polygons.
+    :param thr_img: binary image
+    :param epsilon: maximum distance between a contour and its approximated polygon
+    :param k: number of quadrilaterals to keep, None for all
+    :return: a list of (area, vertices) tuples of the quadrilaterals, largest first
+    """
+    # Find contours
+    # contours = cv2.findContours(thr_img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    _, contours, _ = cv2.findContours(thr_img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    # temporary fix to known issue of a certain version of OpenCV. Depending on OpenCV version, might need to
+    # change this line to read `contours, _ = ...`
+    # CV_RETR_LIST retrieves all of the contours without establishing any hierarchical relationships.
+    # CV_CHAIN_APPROX_SIMPLE compresses horizontal, vertical, and diagonal segments and leaves only end points.
+
+    # Approximate the rectangles that are large enough to be a table
+    min_area = MIN_QUAD_AREA_RATIO * thr_img.shape[0] * thr_img.shape[1]
+    candidates = []
+    for contour in contours:
+        if len(contour) < 4:
+            continue
+        _, _, rect_w, rect_h = cv2.boundingRect(contour)
+        if rect_w * rect_h < min_area:
+            continue
+        # approximate contours to polygons
+        approx_curve = True
+        approx = cv2.approxPolyDP(contour, epsilon, approx_curve)
+        # has 4 sides? is convex?
+        if (len(approx) != 4) or (not cv2.isContourConvex(approx)):
+            continue
+        area = cv2.contourArea(approx)
+        if area >= min_area:
+            candidates.append((area, approx))
+    if k is None:
+        return sorted(candidates, key=itemgetter(0), reverse=True)
+    return heapq.nlargest(k, candidates, key=itemgetter(0))
+
+
+def crop_paper(raw_img, trans_matrix, paper_size):
+    """
+    Crops the region of the photo a paper is warped from, so that it can be sent to another process cheaply.
+    :param raw_img: raw photo
+    :param trans_matrix: perspective transformation from the photo to the paper
+    :param paper_size: (width, height) of the warped paper
+    :return: (cropped photo, perspective transformation from the cropped photo to the paper) as a tuple
+    """
+    h, w = raw_img.shape[:2]
+    corners = np.float32([[0, 0], [paper_size[0], 0], [paper_size[0], paper_size[1]], [0, paper_size[1]]])
+    src_pts = cv2.perspectiveTransform(corners.reshape((-1, 1, 2)), np.linalg.inv(trans_matrix)).reshape((-1, 2))
+    if not np.all(np.isfinite(src_pts)):
+        return raw_img, trans_matrix
+    x0, y0 = np.maximum(np.floor(src_pts.min(axis=0)).astype(int) - CROP_MARGIN, 0)
+    x1, y1 = np.minimum(np.ceil(src_pts.max(axis=0)).astype(int) + CROP_MARGIN, [w, h])
+    shift = np.float64([[1, 0, x0], [0, 1, y0], [0, 0, 1]])
+    return raw_img[y0:y1, x0:x1].copy(), trans_matrix.dot(shift)
+
+
+# pools scanning papers concurrently, by process id, executor and size, so that forked workers start their own; they are
+# created on first use and kept, as starting worker processes costs more than scanning a few papers
+paper_pools = {}
+paper_pools_lock = Lock()
+
+
+def paper_pool(executor, num_workers):
+    """
+    Gets the pool of this process that scans papers concurrently.
+    :param executor: 'thread' or 'process'
+    :param num_workers: size of the pool
+    :return: ThreadPool or Pool object
+    """
+    key = (os.getpid(), executor, num_workers)
+    with paper_pools_lock:
+        if key not in paper_pools:
+            paper_pools[key] = Pool(num_workers) if executor == 'process' else ThreadPool(num_workers)
+        return paper_pools[key]
+
+
+def scan_paper(job):
+    """
+    Warps a paper out of the photo and scans it. Runs in a worker thread or process when scanning concurrently.
+    :param job: (raw photo, perspective transformation from the photo to the paper, number of questions, template id,
+                paper index, whether to record the stages, whether to keep the PaperScan object and its images)
+    :return: (ScanResult object, PaperScan object or None, Recorder object of the stages or None) as a tuple
+    """
+    raw_img, trans_matrix, num_questions, template, i, record, keep_images = job
+    recorder = None
+    if record:
+        with recording() as recorder:
+            paper_obj = warp_and_scan(raw_img, trans_matrix, num_questions, template, i)
+    else:
+        paper_obj = warp_and_scan(raw_img, trans_matrix, num_questions, template, i)
+    return paper_obj.result, paper_obj if keep_images else None, recorder
+
+
+def warp_and_scan(raw_img, trans_matrix, num_questions, template, i):
+    """
+    Warps a paper out of the photo and scans it, as scan_paper().
+    :return: PaperScan object
+    """
+    layout = load_layout(template)
+    with stage('warp'):
+        paper = cv2.warpPerspective(raw_img, trans_matrix, layout.paper_size)
+    # Need to re-threshold raw photo (in PaperScan) because warpPerspective() largely reduces the quality of
+    # the original binary image
+    if DEBUG:
+        cv2.imwrite("tmp/paper%d.png" % i, paper)
+    return PaperScan(paper, num_questions, layout, lambda: rewarp_paper(raw_img, trans_matrix, paper, layout))
+
+
+def rewarp_paper(raw_img, trans_matrix, paper, layout):
+    """
+    Warps a paper out of the photo again, with the corners of its table refined to subpixel accuracy.
+    The corners are refined on the warped paper, where they should lie on the key points of the template, and the
+    correction is applied on top of the first transformation, so that a paper cropped for a worker process comes out
+    the same as from the whole photo.
+    :param raw_img: raw photo
+    :param trans_matrix: perspective transformation from the photo to the paper the paper was first warped with
+    :param paper: raw paper image warped with it
+    :param layout: SheetLayout of the paper
+    :return: raw paper image, or None if the corners hardly move
+    """
+    key_pts = layout.template_key_pts.reshape((-1, 1, 2))
+    refined = key_pts.copy()
+    cv2.cornerSubPix(paper, refined, CORNER_WINDOW, (-1, -1),
+                     (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, CORNER_MAX_ITER, CORNER_EPSILON))
+    if np.abs(refined - key_pts).max() < MIN_CORNER_SHIFT:
+        return None
+    correction = cv2.getPerspectiveTransform(refined.reshape((-1, 2)), layout.template_key_pts)
+    return cv2.warpPerspective(raw_img, correction.dot(trans_matrix), layout.paper_size)
+
+
+def scan_photo(raw_image, num_papers, num_questions=MAX_NUM_QUESTIONS, cache=None, template=DEFAULT_TEMPLATE,
+               **kwargs):
+    """
+    Scans a photo, or returns the cached result if the same photo was scanned before with the same parameters.
+    :param raw_image: image loaded by cv2.imread()
+    :param num_papers: number of papers in the photo
+    :param num_questions: number of questions in the paper
+    :param cache: ResultCache object, None to always scan
+    :param template: id of the sheet format of the papers
+    :param kwargs: further arguments of RawPhoto
+    :return: JSON string of the result, as RawPhoto.dump_data()
+    """
+    key = None
+    if cache is not None:
+        key = image_key(raw_image, num_papers, num_questions, template)
+        res = cache.get(key)
+        if res is not None:
+            return res
+    res = RawPhoto(raw_image, num_papers, num_questions, template=template, **kwargs).dump_data()
+    if cache is not None:
+        cache.put(key, res)
+    return res
+
 
 class RawPhoto:
     """
     Represents each physical, raw photo taken by the user that is to be processed.
-    Each raw photo can contains multiple test papers, so there is a list of PaperScan objects in each RawPhoto object.
+    Each raw photo can contains multiple test papers, so there is a list of ScanResult objects in each RawPhoto object,
+    and, when images are kept, of the PaperScan objects they were read by.
     When used, initialize a RawPhoto object and call dump_data() on it to get the results.
     """
     raw_img = None
     thr_img = None
+    int_img = None
+    scale = 1.0
+    layout = None
     paper_objs = None
+    results = None
+    paper_corners = None
     num_questions = 0
+    executor = None
+    num_workers = PAPER_WORKERS
     metadata = ''
 
-    def __init__(self, raw_image, num_papers, num_questions=MAX_NUM_QUESTIONS):
+    def __init__(self, raw_image, num_papers, num_questions=MAX_NUM_QUESTIONS, detect_size=DETECT_SIZE,
+                 executor=PAPER_EXECUTOR, num_workers=PAPER_WORKERS, template=DEFAULT_TEMPLATE,
+                 keep_images=KEEP_IMAGES):
         """
         Initializes the RawPhoto object.
         The only function that needs to be call (to the RawPhoto object itself) when processing a new photo. All other
@@ -37,84 +231,146 @@ class RawPhoto:
         :param raw_image: image loaded by cv2.imread()
         :param num_papers: number of papers in the photo
         :param num_questions: number of questions in the paper
+        :param detect_size: if the photo is larger, tables are detected on a copy downscaled to this longest side and
+                            then located again at full resolution; None to detect at full resolution
+        :param executor: 'thread' or 'process' to scan the papers in a pool of worker threads or processes, None to scan
+                         them one after another
+        :param num_workers: size of the pool of workers, which is shared by all photos scanned by the process
+        :param template: id of the sheet format of the papers
+        :param keep_images: whether to keep the PaperScan objects, with all their images, in paper_objs; otherwise
+                            only the ScanResult objects are kept, in results
         """
         self.metadata = ''
         self.num_papers = []
+        self.paper_corners = []
         self.raw_img = raw_image
+        self.int_img = None
         self.num_questions = num_questions
+        self.layout = load_layout(template)
+        self.executor = executor
+        self.num_workers = num_workers
+        self.keep_images = keep_images
 
-        # Threshold original image
-        self.thr_img = cv2.adaptiveThreshold(self.raw_img, THR_MAX_VAL, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                             cv2.THRESH_BINARY_INV, THR_BLOCK_SIZE, THR_OFFSET)
+        # Threshold original image, or a downscaled copy of it when detecting coarse-to-fine
+        h, w = self.raw_img.shape[:2]
+        self.scale = 1.0
+        detect_img = self.raw_img
+        with stage('threshold'):
+            if detect_size and max(h, w) > detect_size:
+                self.scale = detect_size / float(max(h, w))
+                detect_img = cv2.resize(self.raw_img, None, fx=self.scale, fy=self.scale,
+                                        interpolation=cv2.INTER_AREA)
+            block_size = max(3, int(THR_BLOCK_SIZE * self.scale) // 2 * 2 + 1)
+            self.thr_img = cv2.adaptiveThreshold(detect_img, THR_MAX_VAL, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                                 cv2.THRESH_BINARY_INV, block_size, THR_OFFSET)
         if DEBUG:
             cv2.imwrite("tmp/self_th.png", self.thr_img)
 
-        # Find contours
-        # contours = cv2.findContours(self.thr_img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        _, contours, _ = cv2.findContours(self.thr_img, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
-        # temporary fix to known issue of a certain version of OpenCV. Depending on OpenCV version, might need to
-        # change this line to read `contours, _ = ...`
-        # CV_RETR_LIST retrieves all of the contours without establishing any hierarchical relationships.
-        # CV_CHAIN_APPROX_SIMPLE compresses horizontal, vertical, and diagonal segments and leaves only end points.
-
-        # Approximate all rectangles
-        # dictionary that maps areas to their corresponding contours
-        approximations = {}
-        for i in range(len(contours)):
-            # approximate contours to polygons
-            approx_curve = True
-            approx = cv2.approxPolyDP(contours[i], 4, approx_curve)
-            # has 4 sides? is convex?
-            if (len(approx) != 4) or (not cv2.isContourConvex(approx)):
-                continue
-            approximations[cv2.contourArea(approx)] = approx
-            # print '> ', approx
-            if DEBUG:
-                pts = np.array([[approx[0][0][0], approx[0][0][1]],
-                                [approx[1][0][0], approx[1][0][1]],
-                                [approx[2][0][0], approx[2][0][1]],
-                                [approx[3][0][0], approx[3][0][1]]], np.int32)
-                pts = pts.reshape((-1, 1, 2))
+        # Find all rectangles
+        with stage('find_contours'):
+            # one more than requested, as the second largest is the reference size of a table
+            candidates = find_quads(self.thr_img, APPROX_EPSILON * self.scale, max(num_papers, 2))
+        # the binary photo is not needed any more; papers are thresholded again after warping
+        self.thr_img = None
+        if DEBUG:
+            for _, approx in candidates:
+                pts = np.int32(approx / self.scale).reshape((-1, 1, 2))
                 cv2.polylines(self.raw_img, [pts], True, (255, 255, 255))
 
         # Extract each individual paper
-        self.paper_objs = self.extract_papers(approximations, num_papers)
+        self.results, self.paper_objs = self.extract_papers(candidates, num_papers)
 
         if DEBUG:
             cv2.imwrite("tmp/paperSelectionTest.png", self.raw_img)
 
-    def extract_papers(self, approximations, num_papers):
+    def extract_papers(self, candidates, num_papers):
         """
         Identify the papers in the photo and initialize the list of PaperScan objects.
-        :param approximations: a dictionary of rectangles in the image (rectangle area -> rectangle vertices)
-                               where each rectangle is the outer edge of the table on the paper
+        The oriented corners of each paper on the photo are kept in paper_corners.
+        :param candidates: a list of (area, vertices) tuples of rectangles in the image, largest first, where each
+                           rectangle may be the outer edge of the table on a paper, at the detection scale
         :param num_papers: number of papers in the image
-        :return: a list of paper objects
+        :return: (list of ScanResult objects, list of PaperScan objects if images are kept or else empty) as a tuple
         """
-        sizes = sorted(list(approximations.keys()))
-        sizes.reverse()
-        papers = []
+        sizes = [area for area, _ in candidates]
+        trans_matrices = []
         for i in range(num_papers):
-            # Break if rectangle is clearly not big enough
+            # Break if rectangle is clearly not big enough, or there is none left
             # factor of smallest allowed rectangle to largest rectangle in the picture
-            if sizes[i] < SIZE_VARIANCE_FACTOR * sizes[1]:
+            if i >= len(sizes) or sizes[i] < SIZE_VARIANCE_FACTOR * sizes[min(1, len(sizes) - 1)]:
                 print('%d paper(s) not detected.' % (num_papers - i))
                 self.metadata += '%d paper(s) not detected.\n' % (num_papers - i)
+                count('papers_not_detected', num_papers - i)
                 break
-            approx = approximations[sizes[i]]
-            raw_refs = self.orientate_vertices(approx)
+            approx = candidates[i][1]
+            if self.scale != 1.0:
+                with stage('refine'):
+                    approx = self.refine_quad(approx)
+            with stage('orientate'):
+                raw_refs = self.orientate_vertices(approx)
             ref_pts = np.float32([[raw_refs[0][0], raw_refs[0][1]],
                                   [raw_refs[1][0], raw_refs[1][1]],
                                   [raw_refs[2][0], raw_refs[2][1]],
                                   [raw_refs[3][0], raw_refs[3][1]]])
-            trans_matrix = cv2.getPerspectiveTransform(ref_pts, TEMPLATE_KEY_PTS)
-            paper = cv2.warpPerspective(self.raw_img, trans_matrix, PAPER_SIZE)
-            # Need to re-threshold raw photo (in PaperScan) because warpPerspective() largely reduces the quality of
-            # the original binary image
-            if DEBUG:
-                cv2.imwrite("tmp/paper%d.png" % i, paper)
-            papers.append(PaperScan(paper, self.num_questions))
-        return papers
+            self.paper_corners.append(ref_pts)
+            trans_matrices.append(cv2.getPerspectiveTransform(ref_pts, self.layout.template_key_pts))
+        # the integral image is only needed to orientate the papers
+        self.int_img = None
+        return self.scan_papers(trans_matrices)
+
+    def scan_papers(self, trans_matrices):
+        """
+        Warps and scans each identified paper, concurrently in the pool of paper_pool() if an executor is configured.
+        Worker processes only receive the region of the photo their paper is warped from, and only send back the
+        results unless images are kept.
+        :param trans_matrices: list of perspective transformations from the photo to each paper
+        :return: (list of ScanResult objects, list of PaperScan objects if images are kept or else empty) as a tuple,
+                 in the same order as the transformations
+        """
+        template = self.layout.template_id
+        recorder = current()
+        extra = (recorder is not None, self.keep_images)
+        if self.executor == 'process' and len(trans_matrices) > 1:
+            jobs = [crop_paper(self.raw_img, trans_matrix, self.layout.paper_size) +
+                    (self.num_questions, template, i) + extra for i, trans_matrix in enumerate(trans_matrices)]
+            pool = paper_pool('process', self.num_workers)
+        else:
+            jobs = [(self.raw_img, trans_matrix, self.num_questions, template, i) + extra
+                    for i, trans_matrix in enumerate(trans_matrices)]
+            pool = None
+            if self.executor == 'thread' and len(jobs) > 1:
+                pool = paper_pool('thread', self.num_workers)
+        if pool is None:
+            scanned = [scan_paper(job) for job in jobs]
+        else:
+            scanned = pool.map(scan_paper, jobs, chunksize=1)
+        # Papers scanned in other threads or processes recorded their stages on their own
+        for _, _, paper_recorder in scanned:
+            if paper_recorder is not None:
+                recorder.merge(paper_recorder)
+        return [result for result, _, _ in scanned], [paper for _, paper, _ in scanned if paper is not None]
+
+    def refine_quad(self, approx):
+        """
+        Locates a table found on the downscaled photo again at full resolution.
+        Only the neighborhood of the coarse table is thresholded and searched, so that the vertices are exactly those a
+        full resolution detection would find, without paying for the rest of the photo. The largest rectangle in that
+        neighborhood is taken as the table.
+        :param approx: vertices of the table rectangle on the downscaled photo
+        :return: vertices of the table rectangle on the full resolution photo
+        """
+        h, w = self.raw_img.shape[:2]
+        margin = int(REFINE_MARGIN / self.scale) + THR_BLOCK_SIZE
+        x, y, rect_w, rect_h = cv2.boundingRect(approx)
+        x0, y0 = max(0, int(x / self.scale) - margin), max(0, int(y / self.scale) - margin)
+        x1, y1 = min(w, int((x + rect_w) / self.scale) + margin), min(h, int((y + rect_h) / self.scale) + margin)
+        roi_thr = cv2.adaptiveThreshold(self.raw_img[y0:y1, x0:x1], THR_MAX_VAL, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                        cv2.THRESH_BINARY_INV, THR_BLOCK_SIZE, THR_OFFSET)
+        candidates = find_quads(roi_thr, k=1)
+        # Keep the coarse vertices if the table does not show up as a whole at full resolution
+        if not candidates or candidates[0][0] < SIZE_VARIANCE_FACTOR * cv2.contourArea(approx) / self.scale ** 2:
+            return np.int32(approx / self.scale)
+        return candidates[0][1] + np.int32([x0, y0])
 
     def orientate_vertices(self, approx):
         """
@@ -148,31 +404,48 @@ class RawPhoto:
             print I, J, K, L
 
         # Check brightnesses
-        brightnesses = []
         offset = int(REF_PT_RANGE * ((A[0] - B[0]) ** 2 + (A[1] - B[1]) ** 2) ** 0.5)
-        for pt in [I, J, K, L]:
-            i_base = pt[0] - offset
-            j_base = pt[1] - offset
-            brightness = 0
-            for i in range(offset * 2):
-                for j in range(offset * 2):
-                    brightness += self.raw_img[j_base + j][i_base + i]
-            brightnesses.append(brightness)
+        brightnesses = self.probe_brightness([I, J, K, L], offset)
         print brightnesses
 
         # Orientate rectangle
-        r_id = brightnesses.index(min(brightnesses))
+        r_id = int(np.argmin(brightnesses))
         transform = {0: B, 1: C, 2: D, 3: A}
         return (transform[r_id], transform[(r_id + 1) % 4],
                 transform[(r_id + 2) % 4], transform[(r_id + 3) % 4])
 
+    def probe_brightness(self, pts, offset):
+        """
+        Measures the mean brightness of the square region around each probe point.
+        All regions are looked up in one integral image of the photo, which is computed on first use and shared by all
+        papers and probes. It is held in floating point, as the sums of a large bright photo do not fit 32 bits. Regions are clipped to the photo, and a region lying entirely outside of it counts as
+        infinitely bright.
+        :param pts: list of (x, y) probe points
+        :param offset: half of the side length of each region
+        :return: array of mean brightnesses, one per probe point
+        """
+        if self.int_img is None:
+            self.int_img = cv2.integral(self.raw_img, sdepth=cv2.CV_64F)
+        h, w = self.raw_img.shape[:2]
+        pts = np.array(pts, dtype=int).reshape(-1, 2)
+        left = np.clip(pts[:, 0] - offset, 0, w)
+        right = np.clip(pts[:, 0] + offset, 0, w)
+        top = np.clip(pts[:, 1] - offset, 0, h)
+        bottom = np.clip(pts[:, 1] + offset, 0, h)
+        area = (right - left) * (bottom - top)
+        sums = rect_sums(self.int_img, top, bottom, left, right)
+        return np.where(area > 0, sums / np.maximum(area, 1.0), np.inf)
+
+    def to_dict(self):
+        """
+        :return: dictionary of the results of the papers and the metadata of the photo, as dump_data() serializes it
+        """
+        return {'papers': [result.to_dict() for result in self.results],
+                'metadata': self.metadata}
+
     def dump_data(self):
         """
         Dumps data to a JSON string
         :return: JSON string
         """
-        data_dict = {'papers': [],
-                     'metadata': self.metadata}
-        for paper in self.paper_objs:
-            data_dict['papers'].append(json.loads(paper.json_res))
-        return json.dumps(data_dict)
+        return json.dumps(self.to_dict())
@@ -0,0 +1,132 @@
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+from layout import load_layout, DEFAULT_TEMPLATE
+
+# Bump whenever a change to the scanner can change the result of a photo, so that older cached results are not served
+SCANNER_VERSION = 2
+
+# Memory tier
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Disk tier
+CACHE_DB_MAX_ENTRIES = 100000
+
+##
+# Caches scan results by the content of the photo, so that a photo submitted again is not scanned again.
+##
+
+
+def cache_key(image_bytes, num_papers, num_questions, template=DEFAULT_TEMPLATE):
+    """
+    Computes the key a scan result is cached by.
+    :param image_bytes: encoded photo, or the raw pixels of a decoded one
+    :param num_papers: number of papers in the photo
+    :param num_questions: number of questions in the paper
+    :param template: id of the sheet format of the papers
+    :return: hex digest of the photo, the scan parameters, the scanner version and the sheet format
+    """
+    h = hashlib.sha1(image_bytes)
+    h.update('|%d|%d|%d|%s' % (num_papers, num_questions, SCANNER_VERSION, load_layout(template).digest))
+    return h.hexdigest()
+
+
+def image_key(raw_image, num_papers, num_questions, template=DEFAULT_TEMPLATE):
+    """
+    Computes the key the scan result of a decoded photo is cached by.
+    :param raw_image: image loaded by cv2.imread()
+    :return: hex digest, as cache_key()
+    """
+    return cache_key('%s|%s' % (raw_image.shape, raw_image.dtype) + raw_image.tobytes(), num_papers, num_questions,
+                     template)
+
+
+class ResultCache:
+    """
+    Two-tier cache of JSON results: a least recently used memory tier bounded by the size of its results, and an
+    optional SQLite tier that survives restarts. Results found on disk are promoted to memory.
+    Safe to share between threads.
+    """
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, db_path=None, db_max_entries=CACHE_DB_MAX_ENTRIES):
+        """
+        :param max_bytes: total size of the results held in memory
+        :param db_path: path of the SQLite database file, None to keep results in memory only
+        :param db_max_entries: number of results kept on disk; the least recently stored ones are dropped first
+        """
+        self.max_bytes = max_bytes
+        self.db_max_entries = db_max_entries
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        self.db = None
+        if db_path is not None:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT NOT NULL)')
+            self.db.commit()
+
+    def get(self, key):
+        """
+        Looks up a result.
+        :param key: key computed by cache_key() or image_key()
+        :return: JSON string of the result, or None if it is not cached
+        """
+        with self.lock:
+            res = self.entries.pop(key, None)
+            if res is not None:
+                self.entries[key] = res
+                self.hits += 1
+                return res
+            if self.db is not None:
+                row = self.db.execute('SELECT result FROM results WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    res = str(row[0])
+                    self.remember(key, res)
+                    self.disk_hits += 1
+                    return res
+            self.misses += 1
+            return None
+
+    def put(self, key, res):
+        """
+        Stores a result in memory and, if there is a database, on disk.
+        :param key: key computed by cache_key() or image_key()
+        :param res: JSON string of the result
+        """
+        with self.lock:
+            if key in self.entries:
+                return
+            self.remember(key, res)
+            if self.db is not None:
+                cursor = self.db.execute('INSERT OR REPLACE INTO results (key, result) VALUES (?, ?)', (key, res))
+                self.db.execute('DELETE FROM results WHERE rowid <= ?', (cursor.lastrowid - self.db_max_entries,))
+                self.db.commit()
+
+    def remember(self, key, res):
+        """
+        Adds a result to the memory tier, evicting the least recently used results until it fits.
+        Must be called with the lock held.
+        """
+        if len(res) > self.max_bytes:
+            return
+        self.entries[key] = res
+        self.size += len(res)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def stats(self):
+        """
+        :return: dictionary of the hit and miss counters and the size of the memory tier
+        """
+        with self.lock:
+            return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                    'entries': len(self.entries), 'bytes': self.size}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,70 @@
+import json
+import numpy as np
+from collections import OrderedDict
+
+
+def encode_answers(marked_ans, option_labels):
+    """
+    Packs the marked answers of a paper into one bitmask per field, bit j standing for the j-th option.
+    :param marked_ans: list of marked answers, each a string of option labels, or 0 for fields not asked for
+    :param option_labels: labels of the options
+    :return: array of bitmasks
+    """
+    bits = dict((label, 1 << j) for j, label in enumerate(option_labels))
+    dtype = np.uint8 if len(option_labels) <= 8 else np.uint32
+    return np.array([sum(bits[label] for label in ans) if ans else 0 for ans in marked_ans], dtype=dtype)
+
+
+class ScanResult(object):
+    """
+    What is left of a paper once it has been scanned: its ids, its answers as an array of bitmasks, how confidently
+    they were read and its metadata.
+    Holds no image, so that any number of results can be kept.
+    """
+    __slots__ = ('test_id', 'paper_id', 'answers', 'num_questions', 'option_labels', 'metadata', 'confidence')
+
+    def __init__(self, test_id, paper_id, answers, num_questions, option_labels, metadata='', confidence=None):
+        """
+        :param test_id: test id read from the datamatrix, '?????' if unreadable
+        :param paper_id: paper id read from the datamatrix, '???' if unreadable
+        :param answers: array of the bitmasks of the marked options of each field, as encode_answers() returns
+        :param num_questions: number of questions asked for; later fields are reported as 0
+        :param option_labels: labels of the options, shared with the layout
+        :param metadata: lines of metadata of the paper
+        :param confidence: array of the confidence of the answer of each field, as PaperScan reads it, None if unknown
+        """
+        self.test_id = test_id
+        self.paper_id = paper_id
+        self.answers = answers
+        self.num_questions = num_questions
+        self.option_labels = option_labels
+        self.metadata = metadata
+        self.confidence = confidence
+
+    def marked_answers(self):
+        """
+        :return: list of the marked answers, each a string of option labels, and 0 for fields not asked for
+        """
+        labels = self.option_labels
+        marked = [''.join(labels[j] for j in range(len(labels)) if mask >> j & 1)
+                  for mask in self.answers[:self.num_questions].tolist()]
+        return marked + [0] * (len(self.answers) - len(marked))
+
+    def to_dict(self):
+        """
+        :return: dictionary of the result, as returned by the API, with its entries in the order they are returned
+        """
+        data_dict = OrderedDict([('test_id', self.test_id),
+                                 ('paper_id', self.paper_id),
+                                 ('answers', self.marked_answers())])
+        if self.confidence is not None:
+            confidence = [round(c, 3) for c in self.confidence[:self.num_questions].tolist()]
+            data_dict['confidence'] = confidence + [0] * (len(self.confidence) - len(confidence))
+        data_dict['metadata'] = self.metadata
+        return data_dict
+
+    def to_json(self):
+        """
+        :return: JSON string of the result
+        """
+        return json.dumps(self.to_dict())
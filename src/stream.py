@@ -0,0 +1,177 @@
+import cv2
+import json
+import numpy as np
+from raw_photo import RawPhoto, warp_and_scan, SIZE_VARIANCE_FACTOR
+from paper_scan import MAX_NUM_QUESTIONS
+from layout import load_layout, DEFAULT_TEMPLATE
+from instrument import stage, count
+
+# Corner tracking
+TRACK_RADIUS = 48           # half of the side of the region around a corner searched in the next frame, in pixels
+TRACK_WINDOW = (21, 21)
+TRACK_PYRAMID_LEVELS = 2
+TRACK_MAX_ERROR = 1.5       # largest distance between a corner and where tracking it back lands, in pixels
+
+# Emitting results
+AGREE_FRAMES = 3
+
+##
+# Scans a stream of frames, e.g. a live camera preview or a video file. The papers are detected on the first frame and
+# then followed from frame to frame by tracking their corners locally, so that most frames only cost the tracking, a
+# warp and the reading of the answers.
+##
+
+
+def track_corner(prev_img, img, pt):
+    """
+    Follows a corner of a paper from one frame to the next by optical flow on the region around it only.
+    :param prev_img: previous grayscale frame
+    :param img: grayscale frame
+    :param pt: (x, y) position of the corner in the previous frame
+    :return: (x, y) position of the corner in the frame, or None if it was lost
+    """
+    h, w = img.shape[:2]
+    x, y = int(pt[0]), int(pt[1])
+    x0, y0 = max(0, x - TRACK_RADIUS), max(0, y - TRACK_RADIUS)
+    x1, y1 = min(w, x + TRACK_RADIUS), min(h, y + TRACK_RADIUS)
+    if x1 - x0 < TRACK_WINDOW[0] or y1 - y0 < TRACK_WINDOW[1]:
+        return None
+    prev_roi = np.ascontiguousarray(prev_img[y0:y1, x0:x1])
+    roi = np.ascontiguousarray(img[y0:y1, x0:x1])
+    start = np.float32([[[pt[0] - x0, pt[1] - y0]]])
+    end, found, _ = cv2.calcOpticalFlowPyrLK(prev_roi, roi, start, None, winSize=TRACK_WINDOW,
+                                             maxLevel=TRACK_PYRAMID_LEVELS)
+    if not found[0][0]:
+        return None
+    # A corner that does not track back onto itself was confused with something else
+    back, found, _ = cv2.calcOpticalFlowPyrLK(roi, prev_roi, end, None, winSize=TRACK_WINDOW,
+                                              maxLevel=TRACK_PYRAMID_LEVELS)
+    if not found[0][0] or np.linalg.norm(back - start) > TRACK_MAX_ERROR:
+        return None
+    return end[0][0] + [x0, y0]
+
+
+def track_paper(prev_img, img, corners):
+    """
+    Follows the corners of a paper from one frame to the next.
+    :param prev_img: previous grayscale frame
+    :param img: grayscale frame
+    :param corners: 4x2 array of the oriented corners of the paper in the previous frame
+    :return: 4x2 array of the corners in the frame, or None if the paper was lost
+    """
+    tracked = []
+    for pt in corners:
+        pt = track_corner(prev_img, img, pt)
+        if pt is None:
+            return None
+        tracked.append(pt)
+    tracked = np.float32(tracked)
+    # The paper has to stay a convex quadrilateral of about the same size
+    if not cv2.isContourConvex(tracked.reshape((-1, 1, 2))):
+        return None
+    ratio = cv2.contourArea(tracked) / max(cv2.contourArea(np.float32(corners)), 1.0)
+    if not SIZE_VARIANCE_FACTOR < ratio < 1 / SIZE_VARIANCE_FACTOR:
+        return None
+    return tracked
+
+
+class StreamScanner:
+    """
+    Scans frames one at a time. Full detection with RawPhoto only runs until all papers are found, and again whenever
+    a paper is lost; in between the papers are tracked. A result is emitted once the same answers have been read on
+    AGREE_FRAMES consecutive frames, unless it is the result emitted last, so that a reading flickering for a frame
+    does not emit it again. Frames agree on the ids and answers read; the confidences change with every frame.
+    """
+    layout = None
+    num_papers = 0
+    num_questions = 0
+    agree_frames = AGREE_FRAMES
+    prev_img = None
+    corners = None
+    last_reading = None
+    emitted = None
+    streak = 0
+    frames = 0
+    detections = 0
+
+    def __init__(self, num_papers, num_questions=MAX_NUM_QUESTIONS, agree_frames=AGREE_FRAMES,
+                 template=DEFAULT_TEMPLATE):
+        """
+        :param num_papers: number of papers in the frames
+        :param num_questions: number of questions in the paper
+        :param agree_frames: number of consecutive frames that have to agree before a result is emitted
+        :param template: id of the sheet format of the papers
+        """
+        self.layout = load_layout(template)
+        self.num_papers = num_papers
+        self.num_questions = num_questions
+        self.agree_frames = agree_frames
+        self.corners = []
+        self.last_reading = None
+        self.emitted = None
+        self.streak = 0
+        self.frames = 0
+        self.detections = 0
+
+    def feed(self, frame):
+        """
+        Scans the next frame.
+        :param frame: grayscale frame
+        :return: JSON string of the result, as RawPhoto.dump_data(), if the answers have just become stable; else None
+        """
+        self.frames += 1
+        tracked = None
+        if self.prev_img is not None and len(self.corners) == self.num_papers:
+            with stage('track'):
+                tracked = [track_paper(self.prev_img, frame, corners) for corners in self.corners]
+            if any(corners is None for corners in tracked):
+                count('tracking_lost')
+                tracked = None
+
+        if tracked is None:
+            self.detections += 1
+            rp = RawPhoto(frame.copy(), self.num_papers, self.num_questions, template=self.layout.template_id)
+            self.corners = rp.paper_corners
+            results, metadata = rp.results, rp.metadata
+        else:
+            self.corners = tracked
+            results, metadata = [], ''
+            for i, corners in enumerate(tracked):
+                trans_matrix = cv2.getPerspectiveTransform(corners, self.layout.template_key_pts)
+                results.append(warp_and_scan(frame, trans_matrix, self.num_questions, self.layout.template_id,
+                                             i).result)
+        self.prev_img = frame
+
+        reading = (tuple((result.test_id, result.paper_id, result.answers.tobytes()) for result in results), metadata)
+        if reading != self.last_reading:
+            self.last_reading, self.streak = reading, 0
+        self.streak += 1
+        if self.streak == self.agree_frames and len(results) == self.num_papers and reading != self.emitted:
+            self.emitted = reading
+            return json.dumps({'papers': [result.to_dict() for result in results], 'metadata': metadata})
+        return None
+
+
+def scan_video(source, num_papers, num_questions=MAX_NUM_QUESTIONS, agree_frames=AGREE_FRAMES,
+               template=DEFAULT_TEMPLATE):
+    """
+    Scans a video file or camera.
+    :param source: path of a video file, or index of a camera
+    :return: iterator of (frame index, JSON string of the result) tuples, one per stable result
+    """
+    scanner = StreamScanner(num_papers, num_questions, agree_frames, template)
+    capture = cv2.VideoCapture(source)
+    try:
+        i = 0
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            if frame.ndim == 3:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            res = scanner.feed(frame)
+            if res is not None:
+                yield i, res
+            i += 1
+    finally:
+        capture.release()